@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2023 Bowe Strickland <bowe@yak.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+"""asyncio MonkeyPod client
+
+Requires httpx (pip install monkeypod-python[async])::
+
+    async with AsyncMonkeyPodClient() as c:
+        results = await asyncio.gather(
+            *[c.entity_match(email=e) for e in emails]
+        )
+"""
+__author__ = 'Bowe Strickland <bowe@ryak.net>'
+__docformat__ = 'restructuredtext'
+
+import logging
+import asyncio
+import contextlib
+import functools
+import itertools
+import time
+
+import attr
+import httpx
+
+from .client import AimdLimiter, MonkeyPodClient
+
+LOG = logging.getLogger(__name__)
+
+
+@attr.s
+class AsyncAimdLimiter(AimdLimiter):
+    """AimdLimiter whose slots are awaited rather than blocked on"""
+
+    @functools.cached_property
+    def _acond(self):
+        return asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, op=None):
+        async with self._acond:
+            await self._acond.wait_for(self._has_room)
+            self.in_flight += 1
+        outcome = {"congested": False}
+        start = time.monotonic()
+        try:
+            yield outcome
+        except Exception:
+            outcome["congested"] = True
+            raise
+        finally:
+            async with self._acond:
+                self.in_flight -= 1
+                self._update(
+                    time.monotonic() - start, outcome["congested"], op,
+                )
+                self._acond.notify_all()
+
+
+@attr.s
+class AsyncMonkeyPodClient(MonkeyPodClient):
+
+    max_connections = attr.ib(default=100)
+    max_keepalive_connections = attr.ib(default=20)
+    timeout = attr.ib(default=30.0)
+
+    # entity_match queries in flight, shared by identical queries
+    _match_tasks = attr.ib(factory=dict, init=False, repr=False)
+
+    @functools.cached_property
+    def session(self):
+        headers = {"Authorization": "Bearer %s" % self.token}
+        headers.update(self.std_headers)
+        return httpx.AsyncClient(
+            headers=headers,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+            ),
+            timeout=self.timeout,
+        )
+
+    async def _send(self, method, path, op=None, **kw):
+        if self.limiter is None:
+            return await self.session.request(method, self._u(path), **kw)
+        async with self.limiter.slot(op) as slot:
+            response = await self.session.request(
+                method, self._u(path), **kw,
+            )
+            slot["congested"] = response.status_code in self.retry_statuses
+        return response
+
+    async def _request(self, method, path, op, **kw):
+        connect, read = self.timeouts.get(op) or (self.timeout, self.timeout)
+        kw.setdefault("timeout", httpx.Timeout(read, connect=connect))
+        for attempt in itertools.count():
+            try:
+                response = await self._send(method, path, op, **kw)
+            except httpx.TransportError as e:
+                unsent = isinstance(
+                    e, (httpx.ConnectError, httpx.ConnectTimeout),
+                )
+                retry = unsent or method in self.idempotent_methods
+                if not retry or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff_delay(attempt)
+                LOG.warning(f"{op} failed ({e!r}), retry in {delay:.1f}s")
+            else:
+                status = response.status_code
+                if (
+                    attempt >= self.max_retries
+                    or not self._should_retry(method, status)
+                ):
+                    return response
+                delay = self._backoff_delay(
+                    attempt, response.headers.get("Retry-After"),
+                )
+                LOG.warning(f"{op} returned {status}, retry in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def aclose(self):
+        if "session" in self.__dict__:
+            await self.session.aclose()
+            del self.__dict__["session"]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def entity_match(
+        self, id=None, email=None, name=None, metadata=None,
+    ):
+        q = self._match_query(id, email, name, metadata)
+        key = tuple(q.items())
+        task = self._match_tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._entity_match(q))
+            self._match_tasks[key] = task
+            task.add_done_callback(lambda _: self._match_tasks.pop(key, None))
+        # one caller's cancellation must not cancel the others
+        return await asyncio.shield(task)
+
+    async def _entity_match(self, q):
+        response = await self._request(
+            "GET", "entities/match", "match", params=q,
+        )
+        response.raise_for_status()
+        return self._index_matched(response.json())
+
+    async def _indexed_match(self, **q):
+        items = self._index_lookup(q)
+        if items is not None:
+            return items
+        return self._match_items(await self.entity_match(**q))
+
+    async def _resolve_unique_match(self, email=None, live=False):
+        if live:
+            items = self._match_items(await self.entity_match(email=email))
+        else:
+            items = await self._indexed_match(email=email)
+        return self._get_unique_item(items)
+
+    async def entity_create(self, data):
+        response = await self._request(
+            "POST", "entities", "create", json=data,
+        )
+        response.raise_for_status()
+        return self._index_created(response.json())
+
+    async def entity_delete(self, id=None, email=None):
+
+        if email and not id:
+            # never trust a possibly stale index with a delete
+            entity = await self._resolve_unique_match(email=email, live=True)
+            id = entity['id']
+
+        response = await self._request(
+            "DELETE", f"entities/{id}", "delete",
+        )
+        response.raise_for_status()
+        return self._index_deleted(id)
+
+# vi: ts=4 expandtab
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2023 Bowe Strickland <bowe@yak.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+__author__ = 'Bowe Strickland <bowe@ryak.net>'
+__docformat__ = 'restructuredtext'
+
+import logging
+import functools
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+
+import attr
+
+LOG = logging.getLogger(__name__)
+
+DFLT_CACHE_DIR = Path("~/.cache/monkeypod").expanduser()
+
+
+@attr.s
+class DiskCache:
+    """sqlite backed key/value store of zlib compressed json payloads
+
+    Entries older than max_age seconds are dropped on read, and evict()
+    trims the table to the max_entries most recently stored.
+    """
+
+    path = attr.ib(default=DFLT_CACHE_DIR / "cache.sqlite")
+    max_age = attr.ib(default=None)
+    max_entries = attr.ib(default=None)
+    table = attr.ib(default="cache")
+    compress_level = attr.ib(default=6)
+
+    evict_every = 1000
+
+    _lock = attr.ib(factory=threading.Lock, init=False, repr=False)
+    _nset = attr.ib(default=0, init=False, repr=False)
+
+    @functools.cached_property
+    def db(self):
+        path = Path(self.path).expanduser()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(
+            str(path), isolation_level=None, check_same_thread=False,
+        )
+        db.execute("pragma journal_mode=wal")
+        db.execute(f"""
+            create table if not exists {self.table} (
+                key text primary key,
+                stored real not null,
+                payload blob not null
+            )
+        """)
+        db.execute(f"""
+            create index if not exists {self.table}_stored
+            on {self.table} (stored)
+        """)
+        return db
+
+    def _expired(self, stored):
+        return self.max_age is not None and stored < time.time() - self.max_age
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self.db.execute(
+                f"select stored, payload from {self.table} where key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return default
+            stored, payload = row
+            if self._expired(stored):
+                self.db.execute(
+                    f"delete from {self.table} where key = ?", (key,),
+                )
+                return default
+        return json.loads(zlib.decompress(payload))
+
+    def set(self, key, value):
+        payload = zlib.compress(
+            json.dumps(value, separators=(",", ":")).encode(),
+            self.compress_level,
+        )
+        with self._lock:
+            self.db.execute(
+                f"insert or replace into {self.table} values (?, ?, ?)",
+                (key, time.time(), payload),
+            )
+            self._nset += 1
+            if self._nset % self.evict_every == 0:
+                self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            self.db.execute(f"delete from {self.table} where key = ?", (key,))
+
+    def _evict(self):
+        n = 0
+        if self.max_age is not None:
+            n += self.db.execute(
+                f"delete from {self.table} where stored < ?",
+                (time.time() - self.max_age,),
+            ).rowcount
+        if self.max_entries is not None:
+            n += self.db.execute(f"""
+                delete from {self.table} where key not in (
+                    select key from {self.table}
+                    order by stored desc limit ?
+                )
+            """, (self.max_entries,)).rowcount
+        if n:
+            LOG.debug(f"evicted {n} entries from {self.table}")
+        return n
+
+    def evict(self):
+        with self._lock:
+            return self._evict()
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute(
+                f"select count(*) from {self.table}"
+            ).fetchone()[0]
+
+# vi: ts=4 expandtab
@@ -22,13 +22,20 @@ __author__ = 'Bowe Strickland <bowe@yak.net>'
 __docformat__ = 'restructuredtext'
 
 import logging
-import csv
+import json
 
+import arrow
 import click
 import yaml
 
-from .client import MonkeyPodClient
-from .manager import MonkeyPodManager
+from .cache import DiskCache, DFLT_CACHE_DIR
+from .client import AimdLimiter, MonkeyPodClient
+from .columnar import ColumnarSink, formats as columnar_formats
+from .csv_ingest import expand_paths, iter_csv_rows
+from .entity_index import EntityIndex
+from .fuzzy import FuzzyMatcher
+from .manager import CsvSink, MonkeyPodManager
+from . import records
 from .stripe_client import StripeClient
 
 LOG = logging.getLogger(__name__)
@@ -44,19 +51,69 @@ logging.basicConfig(level=logging.INFO)
     "-t", "--token",
     help="Authorization token"
 )
+@click.option(
+    "--max-retries", type=int,
+    help="retries of throttled (429) or failed api requests",
+)
+@click.option(
+    "--pool-size", type=int,
+    help="http connections kept alive to the api",
+)
+@click.option(
+    "-j", "--max-concurrency", type=int,
+    help="adaptively limit api requests in flight, up to this many",
+)
+@click.option(
+    "-x", "--index-file", envvar="MONKEYPOD_INDEX",
+    help="local sqlite index of known entities",
+)
+@click.option(
+    "--index-only", is_flag=True,
+    help="trust the local index, don't ask the api on a miss",
+)
+@click.option(
+    "--fuzzy-threshold", type=float,
+    help=(
+        "treat indexed entities with names this similar (0-1) as matches "
+        "for rows without an email; the index is read once at startup"
+    ),
+)
 @click.pass_context
-def monkeypod(ctx, **kw):
+def monkeypod(
+    ctx, max_concurrency, index_file, index_only, fuzzy_threshold, **kw
+):
     """MonkeyPod command line client
 
     Recognized environment variables:
         MONKEYPOD_API="https://[institution].monkeypod.io/api/v2/"
         MONKEYPOD_TOKEN="..."
+        MONKEYPOD_INDEX="path/to/entities.sqlite"
     """
-    kw = {k: v for k, v in kw.items() if v}
+    # keep explicit zeros (--max-retries 0)
+    kw = {k: v for k, v in kw.items() if v is not None}
+    if index_file:
+        kw["index"] = EntityIndex(index_file)
+        kw["index_fallback"] = not index_only
+    if max_concurrency:
+        kw["limiter"] = AimdLimiter(
+            initial=min(4, max_concurrency), max_limit=max_concurrency,
+        )
     ctx.client = MonkeyPodClient(**kw)
-    ctx.manager = MonkeyPodManager(ctx.client)
+    fuzzy = None
+    if fuzzy_threshold:
+        assert index_file, "fuzzy matching requires an --index-file"
+        fuzzy = FuzzyMatcher(fuzzy_threshold)
+        fuzzy.add_entities(ctx.client.index.entities())
+    ctx.manager = MonkeyPodManager(ctx.client, fuzzy=fuzzy)
     LOG.info("using %s" % ctx.client)
 
+    def _report_concurrency():
+        limiter = ctx.client.limiter
+        if limiter is not None and limiter.nrequests > 1:
+            LOG.info(f"api concurrency settled at {limiter.summary()}")
+
+    ctx.call_on_close(_report_concurrency)
+
 
 @monkeypod.group(name="entity")
 @click.pass_context
@@ -99,29 +156,88 @@ def entitydelete(ctx, id, email):
     c = ctx.parent.parent.client
     click.echo(yaml.safe_dump(c.entity_delete(id=id, email=email)))
 
+
+def _read_keys(fd):
+    # one id or email per line, blank lines and comments ignored
+    for line in fd:
+        line = line.split("#", 1)[0].strip()
+        if line:
+            yield line
+
+
+@entity.command(name="match-batch")
+@click.option(
+    "-f", "--filename", type=click.File(), default="-",
+    help="file of ids or emails, one per line (default stdin)",
+)
+@click.option("-w", "--workers", type=int, default=16)
+@click.pass_context
+def entity_match_batch(ctx, filename, workers):
+    """Resolve ids or emails to entities, streaming json lines"""
+    mgr = ctx.parent.parent.manager
+    for result in mgr.batch_match(_read_keys(filename), workers):
+        click.echo(json.dumps(result))
+
+
+@entity.command(name="delete-batch")
+@click.option(
+    "-f", "--filename", type=click.File(), default="-",
+    help="file of ids or emails, one per line (default stdin)",
+)
+@click.option("-w", "--workers", type=int, default=16)
+@click.pass_context
+def entity_delete_batch(ctx, filename, workers):
+    """Delete entities by id or matching email, streaming json lines"""
+    mgr = ctx.parent.parent.manager
+    for result in mgr.batch_delete(_read_keys(filename), workers):
+        click.echo(json.dumps(result))
+
+
+@entity.command(name="index-seed")
+@click.option("-f", "--filename", type=click.File(), required=True)
+@click.pass_context
+def entity_index_seed(ctx, filename):
+    """Seed the local entity index from a .yaml or .json list"""
+    c = ctx.parent.parent.client
+    assert c.index is not None, "an --index-file is required"
+    n = c.index.seed(filename)
+    click.echo(yaml.safe_dump({'seeded': n, 'indexed': len(c.index)}))
+
 #######################################################################
 # imports
 #######################################################################
 
 
-def _ingest_csv_file(fd):
-
-    def _filter_row(data):
-        return {k: v for k, v in data.items() if v}
-
-    reader = csv.DictReader(fd)
-    return [_filter_row(r) for r in reader]
+def _ingest_csv_file(patterns, processes=0):
+    """Lazily iterate filtered rows of csv files, names or globs"""
+    return iter_csv_rows(expand_paths(patterns), processes=processes)
 
 
 @entity.command(name="import-csv")
-@click.option("-f", "--csv-filename", type=click.File())
+@click.option(
+    "-f", "--csv-filename", multiple=True, required=True,
+    help="csv file or glob, may be repeated",
+)
+@click.option(
+    "-P", "--processes", type=int, default=0,
+    help="parse csv chunks in this many processes",
+)
 @click.option("-h", "--headers-yaml", type=click.File())
 @click.option("-s", "--source-attr")
 @click.option("-i", "--import-attr")
+@click.option("-w", "--workers", type=int, default=16)
+@click.option(
+    "-r", "--report", type=click.File("w"),
+    help="csv file recording the outcome of each row",
+)
 @click.pass_context
-def import_csv(ctx, csv_filename, headers_yaml, source_attr, import_attr):
+def import_csv(
+    ctx, csv_filename, processes, headers_yaml, source_attr, import_attr,
+    workers, report,
+):
+    """Import entities from csv files, skipping existing ones"""
 
-    entities = _ingest_csv_file(csv_filename)
+    entities = _ingest_csv_file(csv_filename, processes)
 
     attr_map = None
     if headers_yaml:
@@ -133,6 +249,8 @@ def import_csv(ctx, csv_filename, headers_yaml, source_attr, import_attr):
         attr_map,
         source_attr,
         import_attr,
+        workers=workers,
+        report=report,
     )
     click.echo(yaml.safe_dump(result))
 
@@ -145,43 +263,111 @@ def transaction(ctx):
 
 
 @transaction.command(name="import-stripe-transactions")
-@click.option("-f", "--csv-filename", type=click.File())
-@click.option("-y", "--yaml-filename", type=click.File())
+@click.option("-y", "--yaml-filename", type=click.File("rb"))
+@click.option(
+    "-r", "--records-filename", type=click.File("rb"),
+    help="stripe records as yaml, JSON Lines or msgpack",
+)
+@click.option(
+    "-F", "--format", "record_format", type=click.Choice(records.formats),
+    help="format of --records-filename (default from its extension)",
+)
+@click.option(
+    "-o", "--output-format", default="csv",
+    type=click.Choice(["csv", "jsonl", "msgpack"] + columnar_formats),
+    help="format of the streamed import files (implies --stream)",
+)
 @click.option("-c", "--confirm-entities", is_flag=True)
+@click.option(
+    "-C", "--create-entities", is_flag=True,
+    help="create new entities in MonkeyPod instead of relationship rows",
+)
 @click.option("-t", "--tag")
+@click.option(
+    "-s", "--stream", is_flag=True,
+    help="write csv rows as they are generated, in constant memory",
+)
+@click.option(
+    "--fee-group-by", default="month",
+    type=click.Choice(["month", "day"]),
+    help="how stripe fees are totaled into fee rows",
+)
 @click.pass_context
 def import_stripe_transactions(
-    ctx, csv_filename, yaml_filename, confirm_entities, tag
+    ctx, yaml_filename, records_filename, record_format, output_format,
+    confirm_entities, create_entities, tag, stream, fee_group_by,
 ):
+    """Generate MonkeyPod imports from stripe balance transaction
+    records, as written by "stripe transactions".
+    """
 
-    if csv_filename:
-        rows = _ingest_csv_file(csv_filename)
-        mgr = ctx.parent.parent.manager
-        result = mgr.gen_stripe_imports(rows)
-        click.echo(yaml.safe_dump(result))
+    if not (yaml_filename or records_filename):
+        raise click.UsageError("give -y or -r stripe records")
 
-    elif yaml_filename:
-        recs = yaml.safe_load_all(yaml_filename.read())
-        mgr = ctx.parent.parent.manager
-        result = mgr.gen_stripe_imports_from_recs(
-            recs,
-            confirm_entities=confirm_entities,
-            tag=tag,
-        )
+    if yaml_filename:
+        recs = records.load_records(yaml_filename, "yaml")
+    else:
+        fmt = record_format or records.format_for(records_filename.name)
+        recs = records.load_records(records_filename, fmt)
+
+    mgr = ctx.parent.parent.manager
+    kw = dict(
+        confirm_entities=confirm_entities,
+        create_entities=create_entities,
+        fee_group_by=fee_group_by,
+    )
+    tag = tag or "stripe_" + arrow.utcnow().format("YYYYMMDD")
+    if stream or output_format != "csv":
+        if output_format == "csv":
+            sink = CsvSink(mgr.stripe_import_fields(), tag)
+        elif output_format in columnar_formats:
+            sink = ColumnarSink(
+                output_format, mgr.stripe_import_fields(), tag,
+            )
+        else:
+            sink = records.RecordSink(output_format, tag)
+        with sink:
+            result = mgr.gen_stripe_imports_from_recs(
+                recs, tag=tag, sink=sink, **kw,
+            )
+        click.echo(yaml.safe_dump(result))
+    else:
+        result = mgr.gen_stripe_imports_from_recs(recs, tag=tag, **kw)
+        # with -C, the 'entity' rows record the ids created
+        mgr.write_csvs(result, tag)
 
 
 @transaction.command(name="import-qbmp-transactions")
-@click.option("-f", "--csv-filename", type=click.File(), required=True)
+@click.option(
+    "-f", "--csv-filename", multiple=True, required=True,
+    help="csv file or glob, may be repeated",
+)
+@click.option(
+    "-P", "--processes", type=int, default=0,
+    help="parse csv chunks in this many processes",
+)
 # click.option("-c", "--confirm-entities", is_flag=True)
+@click.option(
+    "--columnar", is_flag=True,
+    help="parse and write whole columns at once (faster on large exports)",
+)
+@click.option(
+    "-o", "--output-format", default="csv",
+    type=click.Choice(["csv"] + columnar_formats),
+    help="write typed, compressed columnar files instead of csvs",
+)
 @click.pass_context
 def import_qbmp_transactions(
-    ctx, csv_filename,
+    ctx, csv_filename, processes,
     # confirm_entities,
+    columnar, output_format,
 ):
 
-    rows = _ingest_csv_file(csv_filename)
+    rows = _ingest_csv_file(csv_filename, processes)
     mgr = ctx.parent.parent.manager
-    result = mgr.gen_qbmarketplace_imports(rows)
+    result = mgr.gen_qbmarketplace_imports(
+        rows, columnar=columnar, fmt=output_format,
+    )
     click.echo(yaml.safe_dump(result))
 
 #################################################################
@@ -190,27 +376,102 @@ def import_qbmp_transactions(
 
 
 @monkeypod.group(name="stripe")
+@click.option(
+    "--expand/--no-expand", "expand_source", default=True,
+    help="expand source charges inline instead of one retrieve per charge",
+)
+@click.option(
+    "-j", "--max-in-flight", type=int, default=8,
+    help="concurrent charge retrieves when not expanding",
+)
+@click.option(
+    "--cache-file", default=str(DFLT_CACHE_DIR / "stripe.sqlite"),
+    help="on disk cache of retrieved charges",
+)
+@click.option("--no-cache", is_flag=True)
+@click.option(
+    "--cache-max-age", type=int, default=400,
+    help="days to keep cached charges",
+)
+@click.option("--cache-max-entries", type=int, default=250000)
+@click.option(
+    "--list-workers", type=int, default=4,
+    help="time shards listed concurrently with --shard-by",
+)
+@click.option(
+    "--prefetch-pages", type=int, default=1,
+    help="pages fetched ahead of processing (0 disables)",
+)
 @click.pass_context
-def stripe(ctx):
-    ctx.stripe = StripeClient()
+def stripe(
+    ctx, expand_source, max_in_flight,
+    cache_file, no_cache, cache_max_age, cache_max_entries, list_workers,
+    prefetch_pages,
+):
+    charge_cache = None
+    if not no_cache:
+        charge_cache = DiskCache(
+            cache_file,
+            max_age=cache_max_age * 24 * 3600,
+            max_entries=cache_max_entries,
+            table="charge",
+        )
+    ctx.stripe = StripeClient(
+        expand_source=expand_source,
+        max_in_flight=max_in_flight,
+        list_workers=list_workers,
+        prefetch_pages=prefetch_pages,
+        charge_cache=charge_cache,
+        watermarks=DiskCache(cache_file, table="watermark"),
+    )
 
 
 @stripe.command(name="customers")
 @click.option("-w", "--when", default="now-1M/M:now-1M/M")
+@click.option(
+    "-i", "--incremental", is_flag=True,
+    help="only list customers created since the last incremental run",
+)
+@click.option(
+    "-s", "--shard-by",
+    type=click.Choice("day week month quarter year".split()),
+    help="list time windows of this size concurrently",
+)
+@click.option(
+    "-F", "--format", "record_format", default="yaml",
+    type=click.Choice(records.formats),
+)
 @click.pass_context
-def stripecustomers(ctx, when):
+def stripecustomers(ctx, when, incremental, shard_by, record_format):
     c = ctx.parent.stripe
-    for obj in c.customer_iter(when):
-        print("---\n" + yaml.safe_dump(obj))
+    itr = c.customer_iter(when, incremental=incremental, shard_by=shard_by)
+    out = click.get_binary_stream("stdout")
+    records.dump_records(itr, out, record_format)
 
 
 @stripe.command(name="transactions")
 @click.option("-w", "--when", default="now-1M/M:now-1M/M")
+@click.option(
+    "-i", "--incremental", is_flag=True,
+    help="only list transactions created since the last incremental run",
+)
+@click.option(
+    "-s", "--shard-by",
+    type=click.Choice("day week month quarter year".split()),
+    help="list time windows of this size concurrently",
+)
+@click.option(
+    "-F", "--format", "record_format", default="yaml",
+    type=click.Choice(records.formats),
+)
 @click.pass_context
-def stripe_transactions(ctx, when):
+def stripe_transactions(ctx, when, incremental, shard_by, record_format):
     c = ctx.parent.stripe
-    for obj in c.balance_transaction_iter(when):
-        print("---\n" + yaml.safe_dump(obj))
+    itr = c.balance_transaction_iter(
+        when, incremental=incremental, shard_by=shard_by,
+    )
+    out = click.get_binary_stream("stdout")
+    records.dump_records(itr, out, record_format)
 
 
 @stripe.group(name="charge")
@@ -22,23 +22,213 @@ __docformat__ = 'restructuredtext'
 import logging
 import os
 import base64
+import collections
+import concurrent.futures
+import contextlib
+import email.utils
 import functools
+import itertools
+import random
+import threading
+import time
 import urllib.parse
 
 import attr
 import json
 import yaml
 import requests
+import requests.adapters
 #import arrow
 #from pydash import py_
 
 LOG = logging.getLogger(__name__)
 
+
+@attr.s
+class AimdLimiter:
+    """Adaptive limit on requests in flight
+
+    The limit grows by about one per round trip (1/limit per success)
+    and is cut by the decrease factor, at most once per round trip, on
+    hard congestion: throttling, 5xx responses or transport errors.
+
+    Latency is only a soft signal, tracked per operation: while an
+    operation's smoothed latency exceeds tolerance times its baseline
+    (the lowest smoothed latency over its last window requests, so the
+    baseline follows the server as it changes) the limit holds rather
+    than grows.  summary() reports where it settled.
+    """
+
+    initial = attr.ib(default=4.0)
+    min_limit = attr.ib(default=1.0)
+    max_limit = attr.ib(default=64.0)
+    decrease = attr.ib(default=0.5)
+    tolerance = attr.ib(default=2.0)
+    smoothing = attr.ib(default=0.1)
+    window = attr.ib(default=200)
+
+    limit = attr.ib(default=None, init=False)
+    in_flight = attr.ib(default=0, init=False)
+    peak = attr.ib(default=0.0, init=False)
+    nrequests = attr.ib(default=0, init=False)
+    ncongested = attr.ib(default=0, init=False)
+    nslow = attr.ib(default=0, init=False)
+    ndecreases = attr.ib(default=0, init=False)
+
+    # op -> smoothed latency, and its recent history
+    latency = attr.ib(factory=dict, init=False)
+    _history = attr.ib(factory=dict, init=False, repr=False)
+    _last_decrease = attr.ib(default=0.0, init=False, repr=False)
+    _cond = attr.ib(factory=threading.Condition, init=False, repr=False)
+
+    def __attrs_post_init__(self):
+        self.limit = float(self.initial)
+        self.peak = self.limit
+
+    def _has_room(self):
+        return self.in_flight < max(1, int(self.limit))
+
+    def _slow(self, op, latency):
+        # smooth per op, and compare against its windowed minimum
+        smoothed = self.latency.get(op)
+        if smoothed is None:
+            smoothed = latency
+        else:
+            a = self.smoothing
+            smoothed = a * latency + (1 - a) * smoothed
+        self.latency[op] = smoothed
+        history = self._history.get(op)
+        if history is None:
+            history = self._history[op] = collections.deque(
+                maxlen=self.window,
+            )
+        history.append(smoothed)
+        return smoothed > self.tolerance * min(history)
+
+    def _update(self, latency, congested, op=None):
+        self.nrequests += 1
+        slow = latency is not None and self._slow(op, latency)
+
+        now = time.monotonic()
+        if congested:
+            self.ncongested += 1
+            if now - self._last_decrease > (latency or 0.0):
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                self._last_decrease = now
+                self.ndecreases += 1
+        elif slow:
+            self.nslow += 1
+        else:
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+        self.peak = max(self.peak, self.limit)
+
+    def acquire(self):
+        with self._cond:
+            self._cond.wait_for(self._has_room)
+            self.in_flight += 1
+
+    def release(self, latency=None, congested=False, op=None):
+        with self._cond:
+            self.in_flight -= 1
+            self._update(latency, congested, op)
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, op=None):
+        """Hold one request slot; set slot["congested"] on throttling."""
+        self.acquire()
+        outcome = {"congested": False}
+        start = time.monotonic()
+        try:
+            yield outcome
+        except Exception:
+            outcome["congested"] = True
+            raise
+        finally:
+            self.release(
+                time.monotonic() - start, outcome["congested"], op,
+            )
+
+    def summary(self):
+        return {
+            'limit': round(self.limit, 1),
+            'peak': round(self.peak, 1),
+            'requests': self.nrequests,
+            'congested': self.ncongested,
+            'slow': self.nslow,
+            'decreases': self.ndecreases,
+            'latency': {k: round(v, 3) for k, v in self.latency.items()},
+        }
+
+
+@attr.s
+class SingleFlight:
+    """Share one call, and its result, between concurrent callers
+    asking with the same key.
+
+    With keep, successful results are also kept for later callers (a
+    memo); failures are always forgotten so the next caller retries.
+    """
+
+    keep = attr.ib(default=False)
+
+    _calls = attr.ib(factory=dict, init=False, repr=False)
+    _lock = attr.ib(factory=threading.Lock, init=False, repr=False)
+
+    def do(self, key, func, *args, **kw):
+        with self._lock:
+            fut = self._calls.get(key)
+            owner = fut is None
+            if owner:
+                fut = self._calls[key] = concurrent.futures.Future()
+        if not owner:
+            return fut.result()
+
+        try:
+            result = func(*args, **kw)
+        except BaseException as e:
+            # waiters see the failure, even an interrupt, not a hang
+            with self._lock:
+                self._calls.pop(key, None)
+            fut.set_exception(e)
+            raise
+        if not self.keep:
+            with self._lock:
+                self._calls.pop(key, None)
+        fut.set_result(result)
+        return result
+
+
 @attr.s
 class MonkeyPodClient:
 
     api = attr.ib(default=os.environ.get("MONKEYPOD_API"))
     token = attr.ib(default=os.environ.get("MONKEYPOD_TOKEN"), repr=False)
+    # optional local mirror of entities (see entity_index.EntityIndex)
+    index = attr.ib(default=None, repr=False)
+    # ask the api when the index has no match
+    index_fallback = attr.ib(default=True)
+
+    # transport tuning
+    pool_size = attr.ib(default=10)
+    max_retries = attr.ib(default=5)
+    backoff_base = attr.ib(default=0.5)
+    backoff_cap = attr.ib(default=30.0)
+    # (connect, read) timeouts by operation
+    timeouts = attr.ib(factory=lambda: {
+        "match": (3.05, 15),
+        "create": (3.05, 30),
+        "delete": (3.05, 30),
+    })
+    # optional AimdLimiter gating concurrent requests
+    limiter = attr.ib(default=None, repr=False)
+
+    # coalesces identical entity_match queries in flight
+    _match_flight = attr.ib(factory=SingleFlight, init=False, repr=False)
+
+    retry_statuses = {429, 500, 502, 503, 504}
+    # only these are retried after the request may have reached the server
+    idempotent_methods = {"GET", "HEAD", "PUT", "DELETE"}
 
     def vet_response(self, resp):
         try:
@@ -60,8 +250,81 @@ class MonkeyPodClient:
         sess = requests.session()
         sess.headers["Authorization"] = "Bearer %s" % self.token
         sess.headers.update(self.std_headers)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.pool_size,
+            pool_maxsize=self.pool_size,
+            max_retries=0,
+        )
+        sess.mount("https://", adapter)
+        sess.mount("http://", adapter)
         return sess
 
+    def _retry_after(self, value):
+        # Retry-After is either delta seconds or an http date
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            when = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, when.timestamp() - time.time())
+
+    def _backoff_delay(self, attempt, retry_after=None):
+        delay = self._retry_after(retry_after)
+        if delay is not None:
+            # one long Retry-After must not stall a bulk job
+            return min(delay, self.backoff_cap)
+        # full jitter exponential backoff
+        return random.uniform(
+            0, min(self.backoff_cap, self.backoff_base * 2 ** attempt),
+        )
+
+    def _should_retry(self, method, status):
+        if status not in self.retry_statuses:
+            return False
+        # a 429 was refused outright, anything else may have been applied
+        return status == 429 or method in self.idempotent_methods
+
+    def _send(self, method, path, op=None, **kw):
+        if self.limiter is None:
+            return self.session.request(method, self._u(path), **kw)
+        with self.limiter.slot(op) as slot:
+            response = self.session.request(method, self._u(path), **kw)
+            slot["congested"] = response.status_code in self.retry_statuses
+        return response
+
+    def _request(self, method, path, op, **kw):
+        """Send a request, retrying throttled and failed responses with
+        jittered exponential backoff (honoring Retry-After).
+        """
+        kw.setdefault("timeout", self.timeouts.get(op))
+        for attempt in itertools.count():
+            try:
+                response = self._send(method, path, op, **kw)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                unsent = isinstance(e, requests.ConnectTimeout)
+                retry = unsent or method in self.idempotent_methods
+                if not retry or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff_delay(attempt)
+                LOG.warning(f"{op} failed ({e}), retry in {delay:.1f}s")
+            else:
+                status = response.status_code
+                if (
+                    attempt >= self.max_retries
+                    or not self._should_retry(method, status)
+                ):
+                    return response
+                delay = self._backoff_delay(
+                    attempt, response.headers.get("Retry-After"),
+                )
+                LOG.warning(f"{op} returned {status}, retry in {delay:.1f}s")
+            time.sleep(delay)
+
     def _dump_response(self, resp):
         print("request")
         print("%s: %s" % (resp.request.method, resp.request.url))
@@ -104,7 +367,7 @@ class MonkeyPodClient:
 #        resp.raise_for_status()
 #        return resp.json()
 
-    def entity_match(self, id=None, email=None, name=None, metadata=None):
+    def _match_query(self, id=None, email=None, name=None, metadata=None):
         q = {}
         if id:
             q['id'] = id
@@ -114,13 +377,60 @@ class MonkeyPodClient:
             q['name'] = name
         if metadata:
             q['metadata'] = metadata
-        qstr = urllib.parse.urlencode(q)
-        response = self.session.get(self._u(f"entities/match?{qstr}"))
+        return q
+
+    def entity_match(self, id=None, email=None, name=None, metadata=None):
+        qstr = urllib.parse.urlencode(
+            self._match_query(id, email, name, metadata)
+        )
+        return self._match_flight.do(qstr, self._entity_match, qstr)
+
+    def _entity_match(self, qstr):
+        response = self._request("GET", f"entities/match?{qstr}", "match")
         response.raise_for_status()
-        payload = response.json()
+        return self._index_matched(response.json())
+
+    def _index_matched(self, payload):
+        """Return the data of a match response, indexing its entities."""
         data = payload.get("data")
+        if self.index is not None:
+            self.index.add_many(self._match_items(data))
         return data
 
+    def _index_created(self, result):
+        if self.index is not None and isinstance(result, dict):
+            self.index.add(result.get("data", result))
+        return result
+
+    def _index_deleted(self, id):
+        if self.index is not None:
+            self.index.remove(id)
+        return {}
+
+    def _match_items(self, data):
+        # match data may arrive as a list, or wrapped as {"data": [...]}
+        if isinstance(data, dict):
+            return data.get("data", [])
+        return data or []
+
+    def _index_lookup(self, q):
+        """Indexed matches for q, or None when the api should be asked."""
+        if self.index is None:
+            return None
+        items = self.index.match(**q)
+        if items or not self.index_fallback:
+            return items
+        return None
+
+    def _indexed_match(self, **q):
+        """Return matching entities from the index when configured,
+        falling back to the api on a miss if index_fallback is set.
+        """
+        items = self._index_lookup(q)
+        if items is not None:
+            return items
+        return self._match_items(self.entity_match(**q))
+
     def _get_unique_item(self, items):
 
         if not items:
@@ -133,24 +443,31 @@ class MonkeyPodClient:
 
         return items[0]
 
-    def _resolve_unique_match(self, email=None):
-        data = self.entity_match(email=email)
-        return self._get_unique_item(data.get("data", []))
+    def _resolve_unique_match(self, email=None, live=False):
+        """The one entity with email; live asks the api even when an
+        index is configured, as destructive operations must.
+        """
+        if live:
+            items = self._match_items(self.entity_match(email=email))
+        else:
+            items = self._indexed_match(email=email)
+        return self._get_unique_item(items)
 
     def entity_create(self, data):
-        response =  self.session.post(self._u("entities"), json=data)
+        response = self._request("POST", "entities", "create", json=data)
         response.raise_for_status()
-        return response.json()
+        return self._index_created(response.json())
 
     def entity_delete(self, id=None, email=None):
 
         if email and not id:
-            entity = self._resolve_unique_match(email=email)
+            # never trust a possibly stale index with a delete
+            entity = self._resolve_unique_match(email=email, live=True)
             id = entity['id']
 
-        response =  self.session.delete(self._u(f"entities/{id}"))
+        response = self._request("DELETE", f"entities/{id}", "delete")
         response.raise_for_status()
-        return {}
+        return self._index_deleted(id)
 
 
 
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2023 Bowe Strickland <bowe@yak.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+"""Typed, compressed columnar import files (Parquet or Arrow IPC)
+
+Requires pyarrow (pip install monkeypod-python[columnar]).  Amount
+columns are written as float64 and Date columns as date32 when every
+value parses, otherwise as strings; everything else is a string.
+Empty values are written as nulls.
+"""
+__author__ = 'Bowe Strickland <bowe@ryak.net>'
+__docformat__ = 'restructuredtext'
+
+import logging
+
+import attr
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:     # pragma: nocover
+    pa = None
+
+LOG = logging.getLogger(__name__)
+
+formats = ["parquet", "arrow"]
+
+format_suffixes = {"parquet": ".parquet", "arrow": ".arrow"}
+
+DFLT_COMPRESSION = "zstd"
+DFLT_BATCH_ROWS = 50000
+
+amount_fields = {"Amount", "Total", "Fee"}
+date_fields = {"Date"}
+date_formats = ["%Y-%m-%d", "%m/%d/%Y"]
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise RuntimeError(
+            "columnar formats require 'pip install pyarrow'"
+        )
+
+
+def _as_strings(values):
+    return pa.array(
+        [None if v is None or v == "" else str(v) for v in values],
+        type=pa.string(),
+    )
+
+
+def _parse_dates(strings):
+    for fmt in date_formats:
+        try:
+            ts = pc.strptime(strings, format=fmt, unit="s")
+        except pa.ArrowInvalid:
+            continue
+        return ts.cast(pa.date32())
+    return None
+
+
+def column_array(name, values, type=None):
+    """Build the array for field name, cast to type when given."""
+    strings = _as_strings(values)
+    if type is not None and type != pa.string():
+        if pa.types.is_date(type):
+            dates = _parse_dates(strings)
+            if dates is None:
+                raise ValueError(f"unparsed dates in {name}")
+            return dates.cast(type)
+        return strings.cast(type)
+    if type is not None:
+        return strings
+    if name in amount_fields:
+        try:
+            return strings.cast(pa.float64())
+        except pa.ArrowInvalid:
+            return strings
+    if name in date_fields:
+        dates = _parse_dates(strings)
+        return strings if dates is None else dates
+    return strings
+
+
+def table_from_columns(fields, columns, schema=None):
+    """Build a table from one iterable of values per field."""
+    _require_pyarrow()
+    arrays = [
+        column_array(f, list(c), schema.field(f).type if schema else None)
+        for f, c in zip(fields, columns)
+    ]
+    return pa.Table.from_arrays(arrays, names=list(fields))
+
+
+def table_from_rows(fields, rows, schema=None):
+    columns = [[r.get(f) for r in rows] for f in fields]
+    return table_from_columns(fields, columns, schema)
+
+
+def write_table(fname, table, fmt="parquet", compression=DFLT_COMPRESSION):
+    LOG.info(f"writing {table.num_rows} rows to {fname}")
+    if fmt == "parquet":
+        pq.write_table(table, fname, compression=compression)
+    elif fmt == "arrow":
+        options = pa.ipc.IpcWriteOptions(compression=compression)
+        with pa.ipc.new_file(fname, table.schema, options=options) as w:
+            w.write_table(table)
+    else:
+        raise ValueError(f"unknown columnar format {fmt}")
+
+
+def write_rows(fname, fields, rows, fmt="parquet", **kw):
+    write_table(fname, table_from_rows(fields, rows), fmt, **kw)
+
+
+def write_columns(fname, fields, columns, fmt="parquet", **kw):
+    write_table(fname, table_from_columns(fields, columns), fmt, **kw)
+
+
+@attr.s
+class ColumnarSink:
+    """Import row sink writing per category Parquet or Arrow files
+
+    The columnar counterpart of manager.CsvSink.  Rows are buffered and
+    written batch_rows at a time, each batch a row group (or record
+    batch) cast to the schema inferred from the category's first batch.
+    """
+
+    fmt = attr.ib()
+    fields = attr.ib()
+    tag = attr.ib()
+    prefix = attr.ib(default="stripe")
+    compression = attr.ib(default=DFLT_COMPRESSION)
+    batch_rows = attr.ib(default=DFLT_BATCH_ROWS)
+
+    counts = attr.ib(factory=dict, init=False)
+    _pending = attr.ib(factory=dict, init=False, repr=False)
+    _writers = attr.ib(factory=dict, init=False, repr=False)
+    _schemas = attr.ib(factory=dict, init=False, repr=False)
+
+    def __attrs_post_init__(self):
+        _require_pyarrow()
+        if self.fmt not in format_suffixes:
+            raise ValueError(f"unknown columnar format {self.fmt}")
+
+    def __call__(self, what, row):
+        self.counts[what] = self.counts.get(what, 0) + 1
+        if not self.fields.get(what):
+            return
+        pending = self._pending.setdefault(what, [])
+        pending.append(row)
+        if len(pending) >= self.batch_rows:
+            self._flush(what)
+
+    def _open(self, what, schema):
+        fname = f"{self.prefix}_{what}_{self.tag}{format_suffixes[self.fmt]}"
+        LOG.info(f"streaming {what} to {fname}")
+        if self.fmt == "parquet":
+            return pq.ParquetWriter(
+                fname, schema, compression=self.compression,
+            )
+        options = pa.ipc.IpcWriteOptions(compression=self.compression)
+        return pa.ipc.new_file(fname, schema, options=options)
+
+    def _flush(self, what):
+        rows = self._pending.pop(what, None)
+        if not rows:
+            return
+        table = table_from_rows(
+            self.fields[what], rows, self._schemas.get(what),
+        )
+        if what not in self._writers:
+            self._schemas[what] = table.schema
+            self._writers[what] = self._open(what, table.schema)
+        self._writers[what].write_table(table)
+
+    def close(self):
+        for what in list(self._pending):
+            self._flush(what)
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# vi: ts=4 expandtab
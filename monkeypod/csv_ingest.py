@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2023 Bowe Strickland <bowe@yak.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+"""Lazy, chunked reading of csv exports
+
+Rows are yielded as dicts without their empty values, file after file.
+With processes, records are split into chunks in the parent (tracking
+quotes so quoted newlines stay inside their record) and parsed by a
+process pool, in order.
+"""
+__author__ = 'Bowe Strickland <bowe@ryak.net>'
+__docformat__ = 'restructuredtext'
+
+import logging
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import glob
+import io
+import itertools
+import sys
+
+LOG = logging.getLogger(__name__)
+
+DFLT_CHUNK_ROWS = 20000
+
+
+def expand_paths(patterns):
+    """Expand file names and glob patterns, in order ('-' is stdin)."""
+    paths = []
+    for pattern in patterns:
+        if pattern == "-" or not glob.has_magic(pattern):
+            paths.append(pattern)
+            continue
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise FileNotFoundError(f"no files match {pattern}")
+        paths.extend(matches)
+    return paths
+
+
+@contextlib.contextmanager
+def _open(path):
+    if path == "-":
+        yield sys.stdin
+    else:
+        with open(path, newline="") as f:
+            yield f
+
+
+def _filter_row(data):
+    return {k: v for k, v in data.items() if v}
+
+
+def _records(fd):
+    # physical lines joined into csv records, quotes balanced
+    parts = []
+    quotes = 0
+    for line in fd:
+        parts.append(line)
+        quotes += line.count('"')
+        if quotes % 2 == 0:
+            yield "".join(parts)
+            parts = []
+            quotes = 0
+    if parts:
+        yield "".join(parts)
+
+
+def parse_chunk(fields, text):
+    reader = csv.DictReader(io.StringIO(text, newline=""), fieldnames=fields)
+    return [_filter_row(r) for r in reader]
+
+
+def _iter_chunks(fd, chunk_rows):
+    records = _records(fd)
+    header = next(records, None)
+    if header is None:
+        return None, iter(())
+    fields = next(csv.reader([header]))
+
+    def _chunks():
+        while True:
+            chunk = "".join(itertools.islice(records, chunk_rows))
+            if not chunk:
+                return
+            yield chunk
+
+    return fields, _chunks()
+
+
+def iter_csv_rows(paths, processes=0, chunk_rows=DFLT_CHUNK_ROWS):
+    """Yield filtered row dicts from each csv file in paths."""
+
+    if not processes:
+        for path in paths:
+            with _open(path) as fd:
+                for row in csv.DictReader(fd):
+                    yield _filter_row(row)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        for path in paths:
+            with _open(path) as fd:
+                fields, chunks = _iter_chunks(fd, chunk_rows)
+                LOG.info(f"parsing {path} in {processes} processes")
+                # keep a couple of chunks per process in flight
+                pending = collections.deque()
+                for chunk in chunks:
+                    pending.append(pool.submit(parse_chunk, fields, chunk))
+                    if len(pending) > 2 * processes:
+                        yield from pending.popleft().result()
+                while pending:
+                    yield from pending.popleft().result()
+
+# vi: ts=4 expandtab
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2023 Bowe Strickland <bowe@yak.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+__author__ = 'Bowe Strickland <bowe@ryak.net>'
+__docformat__ = 'restructuredtext'
+
+import logging
+import functools
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import attr
+import yaml
+
+LOG = logging.getLogger(__name__)
+
+
+def normalize_email(email):
+    return (email or "").strip().lower()
+
+
+def normalize_name(name):
+    return " ".join((name or "").split()).casefold()
+
+
+@attr.s
+class EntityIndex:
+    """Local sqlite mirror of MonkeyPod entities
+
+    MonkeyPod has no "list all" endpoint, so the index is filled from
+    whatever passes through the client (match results, created
+    entities) and optional seed files, and entities are dropped when
+    deleted.  Lookups are by id, normalized email, or normalized name
+    (full name, first and last name, or organization name).
+    """
+
+    path = attr.ib()
+
+    _lock = attr.ib(factory=threading.Lock, init=False, repr=False)
+
+    @functools.cached_property
+    def db(self):
+        path = Path(self.path).expanduser()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(
+            str(path), isolation_level=None, check_same_thread=False,
+        )
+        db.execute("pragma journal_mode=wal")
+        db.executescript("""
+            create table if not exists entity (
+                id text primary key,
+                email text,
+                stored real not null,
+                payload text not null
+            );
+            create index if not exists entity_email on entity (email);
+            create table if not exists entity_name (
+                name text not null,
+                id text not null
+            );
+            create index if not exists entity_name_name on entity_name (name);
+            create index if not exists entity_name_id on entity_name (id);
+        """)
+        return db
+
+    def _names(self, entity):
+        first = entity.get("first_name")
+        middle = entity.get("middle_name")
+        last = entity.get("last_name")
+        names = {
+            entity.get("name"),
+            entity.get("organization_name"),
+            " ".join(n for n in [first, last] if n),
+            " ".join(n for n in [first, middle, last] if n),
+        }
+        names = {normalize_name(n) for n in names if n}
+        return sorted(n for n in names if n)
+
+    def _add(self, entity):
+        id = entity.get("id")
+        if not id:
+            return False
+        self.db.execute(
+            "insert or replace into entity values (?, ?, ?, ?)",
+            (
+                str(id),
+                normalize_email(entity.get("email")) or None,
+                time.time(),
+                json.dumps(entity),
+            ),
+        )
+        self.db.execute("delete from entity_name where id = ?", (str(id),))
+        self.db.executemany(
+            "insert into entity_name values (?, ?)",
+            [(n, str(id)) for n in self._names(entity)],
+        )
+        return True
+
+    def add(self, entity):
+        with self._lock:
+            return self._add(entity)
+
+    def add_many(self, entities):
+        n = 0
+        with self._lock:
+            self.db.execute("begin")
+            try:
+                n = sum(self._add(e) for e in entities)
+            except Exception:
+                self.db.execute("rollback")
+                raise
+            self.db.execute("commit")
+        return n
+
+    def remove(self, id):
+        with self._lock:
+            self.db.execute("delete from entity_name where id = ?", (str(id),))
+            self.db.execute("delete from entity where id = ?", (str(id),))
+
+    def match(self, id=None, email=None, name=None, metadata=None):
+        """Return indexed entities matching all given criteria."""
+        if metadata:
+            # not indexed, let the caller ask the api
+            return []
+        clauses, params = [], []
+        if id:
+            clauses.append("e.id = ?")
+            params.append(str(id))
+        if email:
+            clauses.append("e.email = ?")
+            params.append(normalize_email(email))
+        if name:
+            clauses.append(
+                "e.id in (select id from entity_name where name = ?)"
+            )
+            params.append(normalize_name(name))
+        if not clauses:
+            return []
+        sql = "select e.payload from entity e where " + " and ".join(clauses)
+        with self._lock:
+            rows = self.db.execute(sql, params).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def entities(self):
+        with self._lock:
+            rows = self.db.execute("select payload from entity").fetchall()
+        for (payload,) in rows:
+            yield json.loads(payload)
+
+    def seed(self, fd):
+        """Load entities from a yaml (or json) list or document stream."""
+        n = 0
+        for doc in yaml.safe_load_all(fd):
+            if isinstance(doc, dict):
+                doc = doc.get("data", [doc])
+            n += self.add_many(doc or [])
+        LOG.info(f"seeded {n} entities into {self.path}")
+        return n
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute("select count(*) from entity").fetchone()[0]
+
+# vi: ts=4 expandtab
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2023 Bowe Strickland <bowe@yak.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+__author__ = 'Bowe Strickland <bowe@ryak.net>'
+__docformat__ = 'restructuredtext'
+
+import logging
+import collections
+import math
+import re
+import threading
+
+import attr
+
+LOG = logging.getLogger(__name__)
+
+word_re = re.compile(r"[^\W\d_]+")
+
+ignored_tokens = set("""
+    mr mrs ms miss dr prof rev jr sr ii iii iv
+""".split())
+
+
+def name_tokens(name):
+    """Casefolded name words, without initials, honorifics or suffixes."""
+    return [
+        t for t in word_re.findall((name or "").casefold())
+        if len(t) > 1 and t not in ignored_tokens
+    ]
+
+
+def trigrams(key):
+    padded = f"  {key} "
+    return frozenset(padded[i:i+3] for i in range(len(padded) - 2))
+
+
+def entity_name(entity):
+    name = entity.get("name")
+    if not name:
+        name = " ".join(
+            n for n in [entity.get("first_name"), entity.get("last_name")]
+            if n
+        )
+    return name or entity.get("organization_name")
+
+
+@attr.s
+class FuzzyMatcher:
+    """Approximate name matching against known entities
+
+    Names are reduced to a key of their significant tokens ("Jane Q.
+    Smith" and "jane smith" share a key), and keys are scored by the
+    dice coefficient of their trigrams.  Candidates come from an
+    inverted trigram index using prefix filtering: a key scoring at
+    least the threshold must share one of the query's rarest trigrams,
+    so only those posting lists are read.  Names sharing first and last
+    tokens, where one has extra middle tokens, score 0.95.
+    """
+
+    threshold = attr.ib(default=0.85)
+
+    _keys = attr.ib(factory=list, init=False, repr=False)
+    _grams = attr.ib(factory=list, init=False, repr=False)
+    _entities = attr.ib(factory=list, init=False, repr=False)
+    _postings = attr.ib(
+        factory=lambda: collections.defaultdict(list), init=False, repr=False,
+    )
+    _by_key = attr.ib(factory=dict, init=False, repr=False)
+    _by_ends = attr.ib(
+        factory=lambda: collections.defaultdict(list), init=False, repr=False,
+    )
+    _lock = attr.ib(factory=threading.Lock, init=False, repr=False)
+
+    def add(self, name, entity=None):
+        tokens = name_tokens(name)
+        if not tokens:
+            return False
+        key = " ".join(tokens)
+        grams = trigrams(key)
+        with self._lock:
+            if key in self._by_key:
+                return False
+            idx = len(self._keys)
+            self._keys.append(key)
+            self._grams.append(grams)
+            self._entities.append(
+                entity if entity is not None else {"name": name}
+            )
+            self._by_ends[tokens[0], tokens[-1]].append(idx)
+            for g in grams:
+                self._postings[g].append(idx)
+            # published last, once the entry is complete
+            self._by_key[key] = idx
+        return True
+
+    def add_entities(self, entities):
+        n = sum(self.add(entity_name(e) or "", e) for e in entities)
+        LOG.info(f"fuzzy matching against {n} names")
+        return n
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _candidates(self, grams, threshold):
+        # dice >= t requires at least ceil(t * |q| / (2 - t)) shared grams
+        need = math.ceil(threshold * len(grams) / (2 - threshold))
+        rarest = sorted(grams, key=lambda g: len(self._postings.get(g, ())))
+        found = set()
+        for g in rarest[:max(1, len(grams) - need + 1)]:
+            found.update(self._postings.get(g, ()))
+        return found
+
+    def match(self, name, threshold=None, limit=1):
+        """Return up to limit (score, entity) pairs, best first."""
+        threshold = self.threshold if threshold is None else threshold
+        tokens = name_tokens(name)
+        if not tokens:
+            return []
+        key = " ".join(tokens)
+
+        idx = self._by_key.get(key)
+        if idx is not None:
+            return [(1.0, self._entities[idx])]
+
+        grams = trigrams(key)
+        scores = {}
+        for idx in self._candidates(grams, threshold):
+            other = self._grams[idx]
+            scores[idx] = 2 * len(grams & other) / (len(grams) + len(other))
+
+        q_tokens = set(tokens)
+        for idx in self._by_ends.get((tokens[0], tokens[-1]), ()):
+            o_tokens = set(self._keys[idx].split())
+            if q_tokens <= o_tokens or o_tokens <= q_tokens:
+                scores[idx] = max(scores.get(idx, 0.0), 0.95)
+
+        hits = sorted(
+            ((s, i) for i, s in scores.items() if s >= threshold),
+            reverse=True,
+        )
+        return [(s, self._entities[i]) for s, i in hits[:limit]]
+
+    def best(self, name, threshold=None):
+        hits = self.match(name, threshold)
+        return hits[0] if hits else None
+
+# vi: ts=4 expandtab
@@ -22,7 +22,10 @@ __author__ = 'RHT Platform <gls-platform@redhat.com>'
 __docformat__ = 'restructuredtext'
 
 import logging
+import collections
+import concurrent.futures
 import functools
+import threading
 
 import attr
 
@@ -45,6 +48,39 @@ doc_types = "folder spreadsheet".split()
 mime_types = {d: f"application/vnd.google-apps.{d}" for d in doc_types}
 rev_mime_types = {v: k for k, v in mime_types.items()}
 
+# cells per values.batchUpdate, well under the request size limits
+DFLT_MAX_CELLS = 40000
+DFLT_WRITE_WORKERS = 4
+
+
+# columns identifying a row when syncing, by sheet (None is the default)
+sync_key_fields = {
+    None: ["External ID"],
+    "relationship": ["Email"],
+    "entity": ["Email"],
+    "fee": ["Ref Number", "Date"],
+}
+
+
+def _cells(row):
+    """Row values as compared by sync: trailing blanks dropped, and
+    numbers compared as numbers ("33" matches "33.0").
+    """
+    cells = [str(v) for v in row]
+    while cells and cells[-1] == "":
+        cells.pop()
+    out = []
+    for v in cells:
+        try:
+            out.append(float(v.replace(",", "")))
+        except ValueError:
+            out.append(v)
+    return out
+
+
+def a1_sheet(name):
+    return "'" + name.replace("'", "''") + "'"
+
 
 @attr.s
 class GoogleManager:
@@ -125,6 +161,8 @@ class DriveSpreadsheet(DriveObject):
 
     doc_type = "spreadsheet"
 
+    _local = attr.ib(factory=threading.local, init=False, repr=False)
+
     @functools.cached_property
     def service(self):
         return build("sheets", "v4", credentials=self.manager.creds)
@@ -133,8 +171,23 @@ class DriveSpreadsheet(DriveObject):
     def api(self):
         return self.service.spreadsheets()
 
-    def _add_sheet_req(self, name):
-        return {'addSheet': {'properties': {'title': name}}}
+    def _thread_api(self):
+        # googleapiclient services are not thread safe, one per thread
+        api = getattr(self._local, "api", None)
+        if api is None:
+            service = build("sheets", "v4", credentials=self.manager.creds)
+            api = self._local.api = service.spreadsheets()
+        return api
+
+    def _add_sheet_req(self, name, rows=None):
+        props = {'title': name}
+        if rows:
+            # sized up front, so values never land outside the grid
+            props['gridProperties'] = {
+                'rowCount': len(rows),
+                'columnCount': max(len(r) for r in rows) or 1,
+            }
+        return {'addSheet': {'properties': props}}
 
     def _del_sheet_req(self, idx):
         return {'deleteSheet': {'sheetId': idx}}
@@ -165,6 +218,230 @@ class DriveSpreadsheet(DriveObject):
         ).execute()
         return results
 
+    def _value_batches(self, blocks, max_cells):
+        # blocks are (sheet name, first row number, rows)
+        batch, cells = [], 0
+        for name, first, rows in blocks:
+            width = max((len(r) for r in rows), default=0) or 1
+            start = 0
+            while start < len(rows):
+                room = (max_cells - cells) // width
+                if batch and room < 1:
+                    yield batch
+                    batch, cells = [], 0
+                    continue
+                chunk = rows[start:start + max(1, room)]
+                batch.append({
+                    "range": f"{a1_sheet(name)}!A{first + start}",
+                    "values": chunk,
+                })
+                cells += len(chunk) * width
+                start += len(chunk)
+        if batch:
+            yield batch
+
+    def _write_batch(self, data, value_input_option):
+        return self._thread_api().values().batchUpdate(
+            spreadsheetId=self.doc_id,
+            body={"valueInputOption": value_input_option, "data": data},
+        ).execute()
+
+    def write_many(
+        self, sheets, value_input_option="USER_ENTERED",
+        max_cells=DFLT_MAX_CELLS, workers=DFLT_WRITE_WORKERS,
+    ):
+        """Write {sheet name: rows} from A1 in values.batchUpdate calls
+        of at most max_cells cells each, sent concurrently.
+        """
+        blocks = [(name, 1, rows) for name, rows in sheets.items()]
+        return self.write_blocks(
+            blocks, value_input_option, max_cells=max_cells, workers=workers,
+        )
+
+    def write_blocks(
+        self, blocks, value_input_option="USER_ENTERED",
+        max_cells=DFLT_MAX_CELLS, workers=DFLT_WRITE_WORKERS,
+    ):
+        """Write (sheet name, first row number, rows) blocks, like
+        write_many.
+        """
+        batches = list(self._value_batches(blocks, max_cells))
+        totals = collections.Counter(requests=len(batches))
+
+        def _write(batch):
+            return self._write_batch(batch, value_input_option)
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max(1, min(workers, len(batches)))
+        ) as pool:
+            for result in pool.map(_write, batches):
+                for k in ["totalUpdatedRows", "totalUpdatedCells"]:
+                    totals[k] += result.get(k, 0)
+        return dict(totals)
+
+    def publish(
+        self, sheets, purge=True, value_input_option="USER_ENTERED",
+        max_cells=DFLT_MAX_CELLS, workers=DFLT_WRITE_WORKERS,
+    ):
+        """Add a sheet for each of {sheet name: rows} and fill them.
+
+        A single spreadsheets.batchUpdate adds the sheets (dropping the
+        default one with purge) and returns the updated spreadsheet as
+        info, so no get_info is needed; the values follow through
+        write_many.
+        """
+        rr = [self._add_sheet_req(n, rows) for n, rows in sheets.items()]
+        if purge:
+            rr.append(self._del_sheet_req(0))
+        result = self.api.batchUpdate(
+            spreadsheetId=self.doc_id,
+            body={
+                "requests": rr,
+                "includeSpreadsheetInResponse": True,
+                "responseIncludeGridData": False,
+            },
+        ).execute()
+        self.info = result.get("updatedSpreadsheet", self.info)
+        return self.write_many(
+            sheets, value_input_option, max_cells=max_cells, workers=workers,
+        )
+
+    def read_many(self, names):
+        """Return {sheet name: rows} of formatted values, in one
+        values.batchGet.
+        """
+        if not names:
+            return {}
+        result = self.api.values().batchGet(
+            spreadsheetId=self.doc_id,
+            ranges=[a1_sheet(n) for n in names],
+            majorDimension="ROWS",
+        ).execute()
+        return {
+            n: vr.get("values", [])
+            for n, vr in zip(names, result.get("valueRanges", []))
+        }
+
+    def _sync_sheet(self, rows, current, key_fields):
+        """Plan the writes bringing current up to date with rows, as
+        (first row number, rows) blocks and counts.
+        """
+        header, body = rows[0], rows[1:]
+        key_cols = [header.index(k) for k in key_fields if k in header]
+
+        def _key(row):
+            cells = _cells(row)
+            key = tuple(cells[i] if i < len(cells) else "" for i in key_cols)
+            # rows without key values are matched whole
+            return key if any(key) else ("",) + tuple(cells)
+
+        stats = collections.Counter()
+        if not current or _cells(current[0]) != _cells(header):
+            stats["rewritten"] = 1
+            stats["appended"] = len(body)
+            return [(1, rows)], stats
+
+        existing = collections.defaultdict(collections.deque)
+        for i, row in enumerate(current[1:]):
+            existing[_key(row)].append(i)
+
+        changed, added = {}, []
+        for row in body:
+            found = existing.get(_key(row))
+            if not found:
+                added.append(row)
+                continue
+            i = found.popleft()
+            if _cells(current[i + 1]) == _cells(row):
+                stats["unchanged"] += 1
+            else:
+                changed[i] = row
+        stats["updated"] = len(changed)
+        stats["appended"] = len(added)
+        stats["stale"] = sum(len(v) for v in existing.values())
+
+        # runs of adjacent changed rows go out as one range
+        blocks = []
+        for i in sorted(changed):
+            if blocks and blocks[-1][0] + len(blocks[-1][1]) == i + 2:
+                blocks[-1][1].append(changed[i])
+            else:
+                blocks.append((i + 2, [changed[i]]))
+        if added:
+            blocks.append((len(current) + 1, added))
+        return blocks, stats
+
+    def sync(
+        self, sheets, key_fields=None, value_input_option="USER_ENTERED",
+        max_cells=DFLT_MAX_CELLS, workers=DFLT_WRITE_WORKERS,
+    ):
+        """Bring existing sheets up to date with {sheet name: rows},
+        writing only changed and new rows.
+
+        Current values are read in one values.batchGet and rows are
+        matched on the sheet's key_fields columns (sync_key_fields by
+        default).  Rows changed in place are rewritten where they are,
+        new rows are appended, and rows no longer generated are left
+        alone (counted as stale).  Missing sheets are added, sheets
+        whose header changed are rewritten, and grids are grown, all in
+        at most one spreadsheets.batchUpdate.
+        """
+        key_fields = {**sync_key_fields, **(key_fields or {})}
+        self.info = self.api.get(
+            spreadsheetId=self.doc_id,
+            fields="properties,spreadsheetUrl,sheets.properties",
+        ).execute()
+        props = {
+            s["properties"]["title"]: s["properties"]
+            for s in self.info.get("sheets", [])
+        }
+        current = self.read_many([n for n in sheets if n in props])
+
+        rr, blocks, summary = [], [], {}
+        for name, rows in sheets.items():
+            if name not in props:
+                rr.append(self._add_sheet_req(name, rows))
+                blocks.append((name, 1, rows))
+                summary[name] = {"added": 1, "appended": len(rows) - 1}
+                continue
+
+            keys = key_fields.get(name, key_fields[None])
+            planned, stats = self._sync_sheet(
+                rows, current.get(name, []), keys,
+            )
+            summary[name] = dict(stats)
+            sheet_id = props[name]["sheetId"]
+            if stats["rewritten"]:
+                rr.append({'updateCells': {
+                    'range': {'sheetId': sheet_id},
+                    'fields': 'userEnteredValue',
+                }})
+
+            grid = props[name].get("gridProperties", {})
+            last = max(
+                [first + len(r) - 1 for first, r in planned], default=0,
+            )
+            width = max((len(r) for r in rows), default=0)
+            for dim, need, have in [
+                ("ROWS", last, grid.get("rowCount", 0)),
+                ("COLUMNS", width, grid.get("columnCount", 0)),
+            ]:
+                if need > have:
+                    rr.append({'appendDimension': {
+                        'sheetId': sheet_id,
+                        'dimension': dim,
+                        'length': need - have,
+                    }})
+            blocks.extend((name, first, r) for first, r in planned)
+
+        if rr:
+            self._batch_update(rr)
+        totals = self.write_blocks(
+            blocks, value_input_option, max_cells=max_cells, workers=workers,
+        ) if blocks else {"requests": 0}
+        LOG.info(f"synced {self.doc_id}: {summary}")
+        return {"sheets": summary, **totals}
+
 
 def get_root_folder():
     creds = Credentials.from_service_account_file(
@@ -22,6 +22,7 @@ __author__ = 'RHT Platform <gls-platform@redhat.com>'
 __docformat__ = 'restructuredtext'
 
 import logging
+import sys
 
 import functions_framework
 import arrow
@@ -31,17 +32,27 @@ from pydash import py_
 from stripe_client import StripeClient
 from client import MonkeyPodClient
 from manager import MonkeyPodManager
-from google_workspace import get_root_folder
+from google_workspace import DriveSpreadsheet, get_root_folder
 
 LOG = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-def run():
+def run(spreadsheet_id=None):
+    """Generate last month's stripe imports into a new spreadsheet, or
+    with spreadsheet_id, update that earlier import spreadsheet in place
+    (writing only changed and new rows).
+    """
 
     now = str(arrow.utcnow())[:19]
     tag = f"stripe_import_{now}"
 
+    root_folder = get_root_folder()
+    if spreadsheet_id:
+        si_spreadsheet = DriveSpreadsheet(spreadsheet_id, root_folder.manager)
+        # keep the original tag, so regenerated rows compare equal
+        tag = py_.get(si_spreadsheet.get_info(), "properties.title") or tag
+
     # get iterator to stripe transactions
     sc = StripeClient()
     when = "now-1M/M:now-1M/M"
@@ -54,33 +65,35 @@ def run():
         itr, confirm_entities=True, tag=tag,
     )
 
-    # create the stripe import google sheet
-    root_folder = get_root_folder()
-    si_spreadsheet = root_folder.create(tag, "spreadsheet")
-    info = si_spreadsheet.get_info()
+    # add and fill a sheet per category in a couple of round trips
+    def _extract_data(flds, row):
+        return [str(row.get(k, "")) for k in flds]
+
+    sheets = {}
+    for k in sorted(data):
+        flds = data[k]['fields']
+        rr = [_extract_data(flds, row) for row in data[k]['rows']]
+        sheets[k] = [flds] + rr
+    if spreadsheet_id:
+        result = si_spreadsheet.sync(sheets)
+        action = "updated"
+    else:
+        si_spreadsheet = root_folder.create(tag, "spreadsheet")
+        result = si_spreadsheet.publish(sheets)
+        action = "created"
+    LOG.info(result)
+
+    info = si_spreadsheet.info
     si_name = py_.get(info, "properties.title")
     si_url = py_.get(info, "spreadsheetUrl")
-    LOG.info(f"created spreadsheet {si_name} {si_url}")
-
-    # insert the sheet data
-    si_spreadsheet.add_sheets(sorted(data), purge=True)
-    for k, info in data.items():
-        def _extract_data(flds, row):
-            return [str(row.get(k, "")) for k in flds]
-        flds = info['fields']
-        rr = [_extract_data(flds, row) for row in info['rows']]
-        result = si_spreadsheet.write(
-            f"{k}!A1", [flds] + rr,
-        )
-        result.pop('spreadsheetId')
-        LOG.info(result)
+    LOG.info(f"{action} spreadsheet {si_name} {si_url}")
 
     return f"{si_name} {si_url}"
 
 
 @functions_framework.http
 def my_http_function(request):
-    return run()
+    return run(request.args.get("spreadsheet_id"))
 
 
 @functions_framework.cloud_event
@@ -93,4 +106,4 @@ def handle_event(cloud_event):
 
 
 if __name__ == '__main__':
-    print(run())
+    print(run(*sys.argv[1:2]))
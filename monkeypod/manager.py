@@ -21,8 +21,12 @@ __docformat__ = 'restructuredtext'
 
 import logging
 import collections
+import concurrent.futures
 import csv
+import datetime
+import itertools
 import re
+import time
 from pathlib import Path
 
 import attr
@@ -30,15 +34,229 @@ import arrow
 import yaml
 from pydash import py_
 
+# also imported as a top level module by the cloud function (main.py)
+try:
+    from .columnar import format_suffixes as columnar_suffixes
+    from .columnar import write_columns, write_rows
+except ImportError:
+    from columnar import format_suffixes as columnar_suffixes
+    from columnar import write_columns, write_rows
+
+try:
+    from .fuzzy import entity_name
+except ImportError:
+    from fuzzy import entity_name
+
 LOG = logging.getLogger(__name__)
 
 HERE = Path(__file__)
 
+_MISSING = object()
+_SLOW = object()
+
+
+def compile_path_map(path_map, constants=None):
+    """Compile a {dst key: dotted src path} map into a function
+    extracting those paths from a record, then applying constants.
+
+    Equivalent to py_.has / py_.get / py_.set per key, but with the
+    paths split once.  Plain dict records are walked directly; anything
+    else (lists, objects) and paths pydash would parse specially are
+    left to pydash.
+    """
+    getters = []
+    for key, path in path_map.items():
+        plain = not any(c in path for c in "[]\\")
+        parts = tuple(path.split(".")) if plain else None
+        nested = any(c in key for c in ".[]\\")
+        getters.append((key, path, parts, nested))
+    getters = tuple(getters)
+    constants = dict(constants or {})
+
+    def extract(src):
+        dst = {}
+        for key, path, parts, nested in getters:
+            cur = src if parts is not None else _SLOW
+            for part in parts or ():
+                if type(cur) is not dict:
+                    cur = _SLOW
+                    break
+                cur = cur.get(part, _MISSING)
+                if cur is _MISSING:
+                    break
+            if cur is _SLOW:
+                if not py_.has(src, path):
+                    continue
+                cur = py_.get(src, path)
+            elif cur is _MISSING:
+                continue
+            if nested:
+                py_.set(dst, key, cur)
+            else:
+                dst[key] = cur
+        if constants:
+            dst.update(constants)
+        return dst
+
+    return extract
+
+
+def days_from_civil(y, m, d):
+    """Days since 1970-01-01 of a proleptic gregorian date."""
+    y -= m <= 2
+    era = (y if y >= 0 else y - 399) // 400
+    yoe = y - era * 400
+    doy = (153 * (m + (-3 if m > 2 else 9)) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def civil_from_days(z):
+    """(year, month, day) of a count of days since 1970-01-01."""
+    z += 719468
+    era = (z if z >= 0 else z - 146096) // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    d = doy - (153 * mp + 2) // 5 + 1
+    m = mp + (3 if mp < 10 else -9)
+    return yoe + era * 400 + (m <= 2), m, d
+
+
+@attr.s
+class FeeAggregator:
+    """Stripe fee totals in integer cents
+
+    Fees and amounts are summed in cents per day number as transactions
+    are added, so memory grows with the days covered rather than the
+    transactions, and day totals are rolled up by month (dated the
+    28th, as MonkeyPod fee imports expect) or day on reduce.  Day
+    numbers come straight from epoch seconds or the date digits of iso
+    strings, without building date objects per transaction.
+    """
+
+    group_by = attr.ib(default="month")
+
+    # day number -> [fee, amount, count], in order of first appearance
+    days = attr.ib(factory=dict, repr=False)
+    count = attr.ib(default=0)
+
+    groupings = ["month", "day"]
+
+    def _day_number(self, created):
+        if isinstance(created, (int, float)):
+            return int(created) // 86400
+        if isinstance(created, str):
+            # the local date of the iso string, as arrow would format it
+            return days_from_civil(
+                int(created[0:4]), int(created[5:7]), int(created[8:10]),
+            )
+        if isinstance(created, (datetime.date, datetime.datetime)):
+            return days_from_civil(created.year, created.month, created.day)
+        return self._day_number(str(arrow.get(created)))
+
+    def add(self, record):
+        day = self._day_number(record["created"])
+        totals = self.days.get(day)
+        if totals is None:
+            totals = self.days[day] = [0, 0, 0]
+        totals[0] += round(record["fee"])
+        totals[1] += round(record.get("amount") or 0)
+        totals[2] += 1
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def _date_label(self, day):
+        return "%04d-%02d-%02d" % civil_from_days(day)
+
+    def reduce(self, group_by=None):
+        """Return {group: {'date', 'fee', 'amount', 'count'}} in order of
+        first appearance, with fee and amount in cents.
+        """
+        group_by = group_by or self.group_by
+        if group_by not in self.groupings:
+            raise ValueError(f"unknown fee grouping {group_by}")
+
+        groups = {}
+        for day, (fee, amount, count) in self.days.items():
+            key = self._date_label(day)
+            if group_by == "month":
+                key = key[:8] + "28"
+            g = groups.get(key)
+            if g is None:
+                g = groups[key] = {
+                    'last_day': day, 'fee': 0, 'amount': 0, 'count': 0,
+                }
+            g['fee'] += fee
+            g['amount'] += amount
+            g['count'] += count
+            g['last_day'] = max(g['last_day'], day)
+
+        for g in groups.values():
+            g['date'] = self._date_label(g.pop('last_day'))
+        return groups
+
+
+@attr.s
+class CsvSink:
+    """Sink writing rows to per category csv files as they arrive
+
+    Files are named like write_csvs names them, and opened on their
+    first row.  Categories without fields are counted but not
+    written.
+    """
+
+    fields = attr.ib()
+    tag = attr.ib()
+    prefix = attr.ib(default="stripe")
+
+    counts = attr.ib(factory=collections.Counter, init=False)
+    _files = attr.ib(factory=dict, init=False, repr=False)
+    _writers = attr.ib(factory=dict, init=False, repr=False)
+
+    def __call__(self, what, row):
+        self.counts[what] += 1
+        writer = self._writers.get(what)
+        if writer is None:
+            fields = self.fields.get(what)
+            if not fields:
+                return
+            fname = f"{self.prefix}_{what}_{self.tag}.csv"
+            LOG.info(f"streaming {what} to {fname}")
+            f = self._files[what] = open(fname, "w")
+            writer = self._writers[what] = csv.DictWriter(
+                f, fieldnames=fields,
+            )
+            writer.writeheader()
+        writer.writerow(row)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+        self._writers.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 
 @attr.s
 class MonkeyPodManager:
 
     client = attr.ib()
+    # seconds an entity existence check is remembered (None for the run)
+    entity_memo_ttl = attr.ib(default=None)
+    # optional fuzzy.FuzzyMatcher consulted when names don't match exactly
+    fuzzy = attr.ib(default=None, repr=False)
+
+    # (attr, normalized value) -> (found, expires)
+    _entity_memo = attr.ib(factory=dict, init=False, repr=False)
 
 #    import_path = HERE / "data/imports/monkey_pod_columns.yaml"
 #
@@ -55,68 +273,180 @@ class MonkeyPodManager:
         ndata = {k: v for k, v in ndata.items() if v}
         return ndata
 
-#    def import_entities(
-#        self,
-#        entity_list,
-#        attr_map=None,
-#        source_attr=None,
-#        import_attr=None,
-#    ):
-#        """Import a list of entities.
-#
-#        Skip the entitiy if the email already exists.
-#
-#        'source_attr' and 'import_attr' get added as 'source' and 'import'
-#        extra attributes.
-#
-#        attr_map can be used to reshape attrs from another input shape.
-#        """
-#
-#        nadded = 0
-#        for entity in entity_list:
-#
-#            if attr_map:
-#                entity = self._extract_data(entity, attr_map)
-#
-#            email = entity.get('email')
-#            name = entity.get('name')
-#            # TODO... merge additional attributes into entity
-#            if email:
-#                match = self.client.entity_match(email=email)
-#                if match:
-#                    LOG.info(f"skipping {email}: exists")
-#                    continue
-#            elif name:
-#                if name:
-#                    match = self.client.entity_match(name=name)
-#                    if match:
-#                        LOG.info(f"skipping {name}: exists")
-#                        continue
-#            else:
-#                LOG.debug("skipping no name or email")
-#                continue
-#
-#            entity.setdefault("type", "Individual")
-#
-#            extra = entity.setdefault("extra_attributes", {})
-#            if source_attr:
-#                extra.setdefault("source", source_attr)
-#            if import_attr:
-#                extra.setdefault("import", import_attr)
-#
-#            roles = set(entity.setdefault("roles", []))
-#            roles.add("Donor")
-#            roles.add("Customer")
-#            entity['roles'] = list(roles)
-#
-#            LOG.info(f"creating entity {email} {name}")
-#            LOG.info(os.linesep+yaml.safe_dump(entity))
-#            yesno = input("import entity? (y/N)").strip().lower()
-#            if yesno and yesno[0] == 'y':
-#                _ = self.client.entity_create(entity)
-#                nadded += 1
-#
-#        return nadded
+    def _bounded_map(self, func, items, workers, ordered=True):
+        """Yield (item, result, error) for func(item) over items, run by
+        a pool of workers pulling at most 2 * workers items ahead.
+
+        Results come back in input order, or as they finish when not
+        ordered.
+        """
+        items = iter(items)
+        window = 2 * workers
+
+        def _call(item):
+            try:
+                return item, func(item), None
+            except Exception as e:
+                LOG.warning(f"{func.__name__} failed: {e}")
+                return item, None, e
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            pending = collections.deque(
+                pool.submit(_call, i) for i in itertools.islice(items, window)
+            )
+            while pending:
+                if ordered:
+                    fut = pending.popleft()
+                else:
+                    done, _ = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED,
+                    )
+                    fut = done.pop()
+                    pending.remove(fut)
+                for item in itertools.islice(items, 1):
+                    pending.append(pool.submit(_call, item))
+                yield fut.result()
+
+    import_report_fields = "row status email name id error".split()
+
+    def _import_entity(self, entity):
+        if self._mp_entity_exists(entity):
+            return "exists", None
+        LOG.info(f"creating entity {entity.get('email')} {entity.get('name')}")
+        result = self.client.entity_create(entity)
+        self._remember_entity(entity)
+        if isinstance(result, dict):
+            return "created", result.get("data", result).get("id")
+        return "created", None
+
+    def import_entities(
+        self,
+        entity_list,
+        attr_map=None,
+        source_attr=None,
+        import_attr=None,
+        workers=16,
+        report=None,
+    ):
+        """Import an iterable of entities.
+
+        Entities are deduplicated within the batch by email (or name
+        when there is no email), skipped if they already exist, and
+        created by a bounded pool of workers.
+
+        'source_attr' and 'import_attr' get added as 'source' and 'import'
+        extra attributes.
+
+        attr_map can be used to reshape attrs from another input shape.
+
+        If given, report is a file that gets a csv row per input row
+        with its status (created, exists, duplicate, skipped, failed).
+        Returns the count of rows by status.
+        """
+
+        counts = collections.Counter()
+        writer = None
+        if report:
+            fields = self.import_report_fields
+            writer = csv.DictWriter(report, fieldnames=fields)
+            writer.writeheader()
+
+        def _record(row, entity, status, id=None, error=None):
+            counts[status] += 1
+            if writer:
+                writer.writerow({
+                    'row': row,
+                    'status': status,
+                    'email': entity.get('email'),
+                    'name': entity.get('name'),
+                    'id': id,
+                    'error': error,
+                })
+
+        seen = set()
+
+        def _candidates():
+            for row, entity in enumerate(entity_list):
+
+                if attr_map:
+                    entity = self._extract_data(entity, attr_map)
+
+                email = entity.get('email')
+                name = entity.get('name')
+                if not (email or name):
+                    _record(row, entity, "skipped")
+                    continue
+
+                key = self._entity_memo_key(
+                    *(("email", email) if email else ("name", name))
+                )
+                if key in seen:
+                    _record(row, entity, "duplicate")
+                    continue
+                seen.add(key)
+
+                entity = self._normalize_mp_entity(entity)
+                extra = entity.setdefault("extra_attributes", {})
+                if source_attr:
+                    extra.setdefault("source", source_attr)
+                if import_attr:
+                    extra.setdefault("import", import_attr)
+
+                yield row, entity
+
+        def _import(item):
+            return self._import_entity(item[1])
+
+        results = self._bounded_map(_import, _candidates(), workers)
+        for (row, entity), result, error in results:
+            if error is not None:
+                _record(row, entity, "failed", error=str(error))
+            else:
+                status, id = result
+                _record(row, entity, status, id=id)
+
+        LOG.info(f"imported entities: {dict(counts)}")
+        return dict(counts)
+
+    def _batch_key(self, key):
+        return ("email", key) if "@" in key else ("id", key)
+
+    def _match_one(self, key):
+        what, value = self._batch_key(key)
+        if what == "email":
+            return self.client._resolve_unique_match(email=value)
+        return self.client._get_unique_item(
+            self.client._indexed_match(id=value)
+        )
+
+    def _delete_one(self, key):
+        what, value = self._batch_key(key)
+        return self.client.entity_delete(**{what: value})
+
+    def _batch(self, func, keys, workers, status):
+        results = self._bounded_map(func, keys, workers, ordered=False)
+        for key, result, error in results:
+            if error is None:
+                yield {'input': key, 'status': status, 'result': result}
+            else:
+                yield {
+                    'input': key,
+                    'status': 'error',
+                    'error': f"{type(error).__name__}: {error}",
+                }
+
+    def batch_match(self, keys, workers=16):
+        """Resolve ids or emails to unique entities concurrently,
+        yielding a result per key as each finishes.
+        """
+        return self._batch(self._match_one, keys, workers, "matched")
+
+    def batch_delete(self, keys, workers=16):
+        """Delete entities by id or uniquely matching email concurrently,
+        yielding a result per key as each finishes.
+        """
+        return self._batch(self._delete_one, keys, workers, "deleted")
 
     stripe_mp_entity_map = yaml.safe_load("""
         email: billing_details.email
@@ -143,24 +473,94 @@ class MonkeyPodManager:
         entity = {k: v for k, v in entity.items() if v}
         return entity
 
+    def _entity_memo_key(self, what, value):
+        # monkeypod lowercases emails, names are matched loosely
+        if what == "email":
+            return what, value.strip().lower()
+        return what, " ".join(value.split()).casefold()
+
+    def _entity_match_exists(self, what, value):
+        """Memoized check for an entity matching what=value, caching
+        both hits and misses.
+        """
+        key = self._entity_memo_key(what, value)
+        now = time.monotonic()
+        hit = self._entity_memo.get(key)
+        if hit is not None:
+            found, expires = hit
+            if expires is None or expires > now:
+                return found
+
+        found = bool(self.client._indexed_match(**{what: value}))
+        expires = None
+        if self.entity_memo_ttl is not None:
+            expires = now + self.entity_memo_ttl
+        self._entity_memo[key] = (found, expires)
+        return found
+
+    def _remember_entity(self, entity):
+        """Note a newly created entity as existing for the rest of the run"""
+        expires = None
+        if self.entity_memo_ttl is not None:
+            expires = time.monotonic() + self.entity_memo_ttl
+        for what in ["email", "name"]:
+            if entity.get(what):
+                key = self._entity_memo_key(what, entity[what])
+                self._entity_memo[key] = (True, expires)
+        if self.fuzzy is not None and entity.get("name"):
+            self.fuzzy.add(entity["name"], entity)
+
     def _mp_entity_exists(self, entity):
+        """Whether entity is already in MonkeyPod.
+
+        An entity with an email exists only if that email does; names,
+        exact or fuzzy, decide only for entities without one.
+        """
 
         email = entity.get('email')
         if email:
-            match = self.client.entity_match(email=email)
-            if match:
+            if self._entity_match_exists("email", email):
                 LOG.info(f"mp {email} exists")
                 return True
+            return False
 
         name = entity.get('name')
         if name:
-            match = self.client.entity_match(name=name)
-            if match:
+            if self._entity_match_exists("name", name):
                 LOG.info(f"mp {name} exists")
                 return True
+            if self._fuzzy_match(entity) is not None:
+                return True
 
         return False
 
+    def _fuzzy_match(self, entity):
+        """Return the known entity whose name resembles that of entity
+        (which has no email), or None.
+
+        The matcher knows the entities indexed when it was built, plus
+        those created through _remember_entity since; entities indexed
+        by other means during the run are not seen.
+        """
+        name = entity.get('name')
+        if self.fuzzy is None or entity.get('email') or not name:
+            return None
+        hit = self.fuzzy.best(name)
+        if hit is None:
+            return None
+        score, match = hit
+        LOG.info(f"mp {name} resembles {match.get('id')} ({score:.2f})")
+        return match
+
+    def _alias_entity(self, what, row, match):
+        """Point a donation or sale row at a fuzzy matched entity, so it
+        names a donor MonkeyPod knows rather than the stripe one.
+        """
+        field = {'donation': 'Donor', 'sale': 'Customer'}.get(what)
+        ident = match.get('email') or entity_name(match)
+        if field and ident:
+            row[field] = ident
+
     def _normalize_mp_entity(self, entity):
 
         entity.setdefault("type", "Individual")
@@ -185,12 +585,21 @@ class MonkeyPodManager:
 #        )
 #        return entity
 
-    def _extract_path_map(self, src, path_map):
-        dst = {}
-        for k, v in path_map.items():
-            if py_.has(src, v):
-                py_.set(dst, k, py_.get(src, v))
-        return dst
+    # id(path map), id(constants) -> (path map, constants, extractor);
+    # the maps are kept so their ids stay valid
+    _compiled_maps = {}
+
+    def _compiled_path_map(self, path_map, constants=None):
+        key = (id(path_map), id(constants))
+        hit = self._compiled_maps.get(key)
+        if hit is None:
+            hit = self._compiled_maps[key] = (
+                path_map, constants, compile_path_map(path_map, constants),
+            )
+        return hit[2]
+
+    def _extract_path_map(self, src, path_map, constants=None):
+        return self._compiled_path_map(path_map, constants)(src)
 
     #####################################################################
     # stripe imports
@@ -310,45 +719,146 @@ class MonkeyPodManager:
         - External ID
     """)
 
+    created_entity_fields = ["Email", "Name", "ID", "Status", "Error"]
+
+    def _relationship_row(self, mp_entity, tag):
+        _, r_row = self._generate_relationship(mp_entity)
+        r_row["Import"] = tag
+        return r_row
+
+    def _create_stripe_entity(self, mp_entity, tag):
+        entity = self._normalize_mp_entity(dict(mp_entity))
+        extra = entity.setdefault("extra_attributes", {})
+        extra.setdefault("source", "stripe")
+        extra.setdefault("import", tag)
+        return self._import_entity(entity)
+
+    def stripe_import_fields(self):
+        fields = {k: v['fields'] for k, v in self.stripe_import_map.items()}
+        fields['entity'] = self.created_entity_fields
+        return fields
+
     def gen_stripe_imports_from_recs(
         self, stripe_transactions, tag=None, confirm_entities=False,
+        create_entities=False, workers=8, sink=None, fee_group_by="month",
     ):
+        """Generate import rows by category from stripe transactions.
+
+        Rows are collected and returned by category, unless a sink is
+        given, in which case each row is passed to sink(what, row) as
+        it is generated, only fee totals are held until the end, and
+        row counts are returned in place of rows.
+
+        With confirm_entities or create_entities and a fuzzy matcher,
+        entities without an email whose name resembles a known entity
+        are taken to be that entity: no relationship row is generated
+        or entity created, and their donation and sale rows name the
+        matched entity (by email, else name) instead.
+
+        With create_entities, entities not yet in MonkeyPod are created
+        directly by a pool of workers as they are discovered, rather than
+        becoming relationship rows, and their outcomes are returned
+        under 'entity'.  Each entity is checked for and created at most
+        once per run, so reruns don't duplicate them.  Entities that fail
+        to be created fall back to relationship rows.
+        """
 
         tag = tag or "stripe_" + arrow.utcnow().format("YYYYMMDD")
         collector = collections.defaultdict(list)
-        fee_collector = collections.defaultdict(lambda: 0.0)
+        counts = collections.Counter()
+        fee_collector = FeeAggregator(fee_group_by)
         n_entities = n_new_entities = 0
 
-        for stripe_tx in stripe_transactions:
-
-            mp_entity = self._extract_mp_entity_from_stripe_tx(stripe_tx)
-            if mp_entity:
-                n_entities += 1
-                if not (
-                    confirm_entities and self._mp_entity_exists(mp_entity)
-                ):
-                    _, r_row = self._generate_relationship(mp_entity)
-                    r_row["Import"] = tag
-                    collector['relationship'].append(r_row)
-                    n_new_entities += 1
-
-            what, row = self._stripe_generate_import_row(stripe_tx)
-            collector[what].append(row)
-            self._collect_fee(fee_collector, stripe_tx)
-
-        data = dict(collector)
-        data["fee"] = self._reduce_fees(fee_collector)
+        def _emit(what, row):
+            counts[what] += 1
+            if sink is None:
+                collector[what].append(row)
+            else:
+                sink(what, row)
+
+        creating = {}
+        pool = None
+        if create_entities:
+            pool = concurrent.futures.ThreadPoolExecutor(workers)
+
+        try:
+            for stripe_tx in stripe_transactions:
+
+                mp_entity = self._extract_mp_entity_from_stripe_tx(stripe_tx)
+                match = None
+                if mp_entity:
+                    n_entities += 1
+                    if confirm_entities or create_entities:
+                        # checked here, so the rows below can name it
+                        match = self._fuzzy_match(mp_entity)
+                if mp_entity and match is None:
+                    if create_entities:
+                        email = mp_entity.get('email')
+                        key = self._entity_memo_key(
+                            *(("email", email) if email
+                              else ("name", mp_entity.get('name', '')))
+                        )
+                        if key not in creating:
+                            creating[key] = mp_entity, pool.submit(
+                                self._create_stripe_entity, mp_entity, tag,
+                            )
+                    elif not (
+                        confirm_entities and self._mp_entity_exists(mp_entity)
+                    ):
+                        _emit(
+                            'relationship',
+                            self._relationship_row(mp_entity, tag),
+                        )
+                        n_new_entities += 1
+
+                what, row = self._stripe_generate_import_row(stripe_tx)
+                if match is not None:
+                    self._alias_entity(what, row, match)
+                _emit(what, row)
+                self._collect_fee(fee_collector, stripe_tx)
+        finally:
+            if pool:
+                pool.shutdown(wait=True)
+
+        for mp_entity, fut in creating.values():
+            id = error = None
+            try:
+                status, id = fut.result()
+            except Exception as e:
+                status, error = "failed", str(e)
+                LOG.warning(f"creating {mp_entity} failed: {e}")
+                _emit('relationship', self._relationship_row(mp_entity, tag))
+            if status == "created":
+                n_new_entities += 1
+            _emit('entity', {
+                'Email': mp_entity.get('email'),
+                'Name': mp_entity.get('name'),
+                'ID': id,
+                'Status': status,
+                'Error': error,
+            })
+
+        for row in self._reduce_fees(fee_collector):
+            _emit('fee', row)
 
         LOG.info(f"import {n_new_entities} out of {n_entities} entities")
 
         # reshape data map to include data and fields
-        _sim = self.stripe_import_map
+        fields = self.stripe_import_fields()
+        if sink is not None:
+            return {
+                k: {'count': n, 'fields': fields.get(k)}
+                for k, n in counts.items()
+            }
         return {
-            k: {'rows': rows, 'fields': _sim[k]['fields']}
-            for k, rows in data.items()
+            k: {'rows': rows, 'fields': fields[k]}
+            for k, rows in collector.items()
         }
 
-    def write_csvs(self, data, tag):
+    def write_csvs(self, data, tag, fmt="csv"):
+        """Write each category's rows as csv, or with fmt "parquet" or
+        "arrow" as typed, compressed columnar files.
+        """
 
         def _write_csv(what, tag, fields, records):
             fname = f"stripe_{what}_{tag}.csv"
@@ -358,9 +868,15 @@ class MonkeyPodManager:
                 writer.writeheader()
                 [writer.writerow(r) for r in records]
 
+        def _write_columnar(what, tag, fields, records):
+            suffix = columnar_suffixes[fmt]
+            fname = f"stripe_{what}_{tag}{suffix}"
+            write_rows(fname, fields, records, fmt)
+
+        write = _write_csv if fmt == "csv" else _write_columnar
         for k in data:
-            if k in self.stripe_import_map:
-                _write_csv(k, tag, data[k]['fields'], data[k]['rows'])
+            if k in self.stripe_import_map or k == 'entity':
+                write(k, tag, data[k]['fields'], data[k]['rows'])
 
     def _stripe_generate_import_row(self, record):
 
@@ -396,8 +912,9 @@ class MonkeyPodManager:
 
     def _generate_base(self, what, record):
         si_map = self.stripe_import_map[what]
-        dst = self._extract_path_map(record, si_map["paths"])
-        dst.update(si_map["constants"])
+        dst = self._extract_path_map(
+            record, si_map["paths"], si_map["constants"],
+        )
         self._normalize_record(dst)
         return dst
 
@@ -433,11 +950,12 @@ class MonkeyPodManager:
         return "sale", dst
 
     def _collect_fee(self, collector, record):
-        when = arrow.get(record["created"]).format("YYYY-MM") + "-28"
-        collector[when] += record["fee"]
+        collector.add(record)
 
     def _reduce_fees(self, collector):
-        rows = [{'Date': k, 'Amount': v} for k, v in collector.items()]
+        rows = []
+        for key, g in collector.reduce().items():
+            rows.append({'Date': key, 'Amount': g['fee']})
         rows = [self._generate_base("fee", r) for r in rows]
         return rows
 
@@ -493,13 +1011,87 @@ class MonkeyPodManager:
 
     digit_re = re.compile(r"[\d.]+")
 
-    def gen_qbmarketplace_imports(self, rows, tag=None):
+    # first number on each line of a newline joined column
+    digit_line_re = re.compile(r"^[^\d.\n]*([\d.]+)", re.M)
+
+    def _qb_parse_amounts(self, values):
+        """Parse the first number out of each value, a column at a time."""
+        text = "\n".join(values)
+        if text.count("\n") == len(values) - 1:
+            found = self.digit_line_re.findall(text)
+            if len(found) == len(values):
+                return list(map(float, found))
+        # some value spans lines or has no number, go one at a time
+        return [float(self.digit_re.search(v).group()) for v in values]
+
+    def _qb_columns(self, rows):
+        """Pivot rows having an Amount into columns, with amounts parsed,
+        dates trimmed, and None where a row lacks a value.
+        """
+        rows = [r for r in rows if 'Amount' in r]
+        keys = {k: None for r in rows for k in r}
+        cols = {k: [r.get(k) for r in rows] for k in keys}
+        if not rows:
+            return cols, 0
+
+        for k in ['Amount', 'Fee']:
+            cols[k] = self._qb_parse_amounts(cols[k])
+        cols['Date'] = [d.split()[0] for d in cols['Date']]
+        cols['Cardholder Name'] = [
+            v or "unknown"
+            for v in cols.get('Cardholder Name', [None] * len(rows))
+        ]
+        return cols, len(rows)
+
+    def _qb_project(self, cols, n, si_map):
+        """Output columns for si_map, in field order."""
+        out = {
+            k: cols[v] for k, v in si_map["paths"].items() if v in cols
+        }
+        out.update({
+            k: itertools.repeat(v, n) for k, v in si_map["constants"].items()
+        })
+        return [
+            out[f] if f in out else itertools.repeat("", n)
+            for f in si_map["fields"]
+        ]
+
+    def _gen_qbmarketplace_columnar(self, rows, tag, fmt="csv"):
+        cols, n = self._qb_columns(rows)
+        for k, si_map in self.qb_import_map.items():
+            if fmt != "csv":
+                suffix = columnar_suffixes[fmt]
+                write_columns(
+                    f"qbmarketplace_{k}_{tag}{suffix}", si_map["fields"],
+                    self._qb_project(cols, n, si_map), fmt,
+                )
+                continue
+            fname = f"qbmarketplace_{k}_{tag}.csv"
+            LOG.info(f"writing {n} {k} to {fname}")
+            with open(fname, "w") as f:
+                writer = csv.writer(f)
+                writer.writerow(si_map["fields"])
+                writer.writerows(zip(*self._qb_project(cols, n, si_map)))
+
+    def gen_qbmarketplace_imports(
+        self, rows, tag=None, columnar=False, fmt="csv",
+    ):
+        """Write QuickBooks marketplace sale and fee import csvs.
+
+        With columnar, rows are pivoted into columns that are parsed and
+        projected in bulk, which is much faster on large exports.  fmt
+        "parquet" or "arrow" writes typed, compressed columnar files
+        instead of csvs (always through the columnar path).
+        """
 
         collector = {'sale': [], 'fee': []}
 
         if not tag:
             tag = "qb_marketplace_" + arrow.utcnow().format("YYYYMMDD")
 
+        if columnar or fmt != "csv":
+            return self._gen_qbmarketplace_columnar(rows, tag, fmt)
+
         # filter out empty rows
         for row in rows:
 
@@ -514,13 +1106,15 @@ class MonkeyPodManager:
             row.setdefault("Cardholder Name", "unknown")
 
             si_map = self.qb_import_map['sale']
-            item = self._extract_path_map(row, si_map["paths"])
-            item.update(si_map["constants"])
+            item = self._extract_path_map(
+                row, si_map["paths"], si_map["constants"],
+            )
             collector['sale'].append(item)
 
             si_map = self.qb_import_map['fee']
-            item = self._extract_path_map(row, si_map["paths"])
-            item.update(si_map["constants"])
+            item = self._extract_path_map(
+                row, si_map["paths"], si_map["constants"],
+            )
             collector['fee'].append(item)
 
         for k in collector:
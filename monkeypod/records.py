@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2023 Bowe Strickland <bowe@yak.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+"""Record streams as yaml documents, JSON Lines, or msgpack
+
+All streams are binary.  JSON Lines input may also be a single json
+array of records.  orjson is used for JSON Lines when installed,
+msgpack is required only for the msgpack format, and yaml uses the
+libyaml C loader and dumper when available.
+"""
+__author__ = 'Bowe Strickland <bowe@ryak.net>'
+__docformat__ = 'restructuredtext'
+
+import logging
+import json
+from pathlib import Path
+
+import attr
+import yaml
+
+try:
+    import orjson
+except ImportError:     # pragma: nocover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:     # pragma: nocover
+    msgpack = None
+
+LOG = logging.getLogger(__name__)
+
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YamlDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+formats = ["yaml", "jsonl", "msgpack"]
+
+suffix_formats = {
+    ".yaml": "yaml",
+    ".yml": "yaml",
+    ".jsonl": "jsonl",
+    ".ndjson": "jsonl",
+    ".json": "jsonl",
+    ".msgpack": "msgpack",
+    ".mpk": "msgpack",
+}
+
+format_suffixes = {"yaml": ".yaml", "jsonl": ".jsonl", "msgpack": ".msgpack"}
+
+
+def format_for(path, default="yaml"):
+    return suffix_formats.get(Path(str(path)).suffix.lower(), default)
+
+
+def _require_msgpack():
+    if msgpack is None:
+        raise RuntimeError("the msgpack format requires 'pip install msgpack'")
+
+
+def dumps_json(obj):
+    if orjson is not None:
+        return orjson.dumps(
+            obj, default=str, option=orjson.OPT_APPEND_NEWLINE,
+        )
+    return (json.dumps(obj, default=str) + "\n").encode()
+
+
+def loads_json(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dump_record(obj, fmt):
+    """Serialize one record as bytes in fmt."""
+    if fmt == "yaml":
+        text = yaml.dump(obj, Dumper=YamlDumper)
+        return b"---\n" + text.encode()
+    if fmt == "jsonl":
+        return dumps_json(obj)
+    if fmt == "msgpack":
+        _require_msgpack()
+        return msgpack.packb(obj, default=str)
+    raise ValueError(f"unknown record format {fmt}")
+
+
+def dump_records(itr, fd, fmt):
+    """Write records from itr to the binary stream fd, returning a count."""
+    n = 0
+    for obj in itr:
+        fd.write(dump_record(obj, fmt))
+        n += 1
+    fd.flush()
+    return n
+
+
+def load_records(fd, fmt):
+    """Lazily iterate records from the binary stream fd."""
+    if fmt == "yaml":
+        for doc in yaml.load_all(fd, Loader=YamlLoader):
+            if doc is not None:
+                yield doc
+    elif fmt == "jsonl":
+        for line in fd:
+            if not line.strip():
+                continue
+            if line.lstrip().startswith(b"["):
+                # a plain json array (a .json file) is read whole
+                yield from loads_json(line + fd.read())
+                return
+            yield loads_json(line)
+    elif fmt == "msgpack":
+        _require_msgpack()
+        yield from msgpack.Unpacker(fd, raw=False)
+    else:
+        raise ValueError(f"unknown record format {fmt}")
+
+
+@attr.s
+class RecordSink:
+    """Import row sink writing per category record files
+
+    The record format counterpart of manager.CsvSink.
+    """
+
+    fmt = attr.ib()
+    tag = attr.ib()
+    prefix = attr.ib(default="stripe")
+
+    counts = attr.ib(factory=dict, init=False)
+    _files = attr.ib(factory=dict, init=False, repr=False)
+
+    def __call__(self, what, row):
+        self.counts[what] = self.counts.get(what, 0) + 1
+        f = self._files.get(what)
+        if f is None:
+            suffix = format_suffixes[self.fmt]
+            fname = f"{self.prefix}_{what}_{self.tag}{suffix}"
+            LOG.info(f"streaming {what} to {fname}")
+            f = self._files[what] = open(fname, "wb")
+        f.write(dump_record(row, self.fmt))
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# vi: ts=4 expandtab
@@ -21,7 +21,13 @@ __docformat__ = 'restructuredtext'
 
 import logging
 import os
+import collections
+import concurrent.futures
 import functools
+import hashlib
+import itertools
+import queue
+import threading
 
 import attr
 import stripe
@@ -29,6 +35,12 @@ import arrow
 import datemath
 from pydash import py_
 
+# also imported as a top level module by the cloud function (main.py)
+try:
+    from .client import SingleFlight
+except ImportError:
+    from client import SingleFlight
+
 LOG = logging.getLogger(__name__)
 stripe.api_key = os.environ.get("STRIPE_API_KEY")
 
@@ -41,6 +53,27 @@ class StripeClient:
     """.split()
 
     api_key = attr.ib(default=os.environ.get("STRIPE_API_KEY"))
+    # expand the source charge inline in list pages rather than
+    # retrieving each charge separately
+    expand_source = attr.ib(default=True)
+    page_size = attr.ib(default=100)
+    # pages fetched in the background ahead of the consumer (0 disables)
+    prefetch_pages = attr.ib(default=1)
+    # charges retrieved concurrently when not expanded inline
+    max_in_flight = attr.ib(default=8)
+    # time shards listed concurrently by sharded listings
+    list_workers = attr.ib(default=4)
+    # optional persistent store (see cache.DiskCache) of settled charges
+    charge_cache = attr.ib(default=None, repr=False)
+    # optional persistent store of per account listing watermarks
+    watermarks = attr.ib(default=None, repr=False)
+
+    # charges seen this run, keyed by id; concurrent lookups of the
+    # same charge share one retrieve
+    _charges = attr.ib(
+        factory=lambda: SingleFlight(keep=True), init=False, repr=False,
+    )
+
     dflt_when = "now-1M/M:now-1M/M"  # last month
 
     def _to_timestamp(self, time_str):
@@ -69,6 +102,68 @@ class StripeClient:
         for obj in itr:
             yield self._from_stripe_item(obj)
 
+    def _run_ahead(self, func, itr, max_in_flight=None):
+        """Yield func(item) for each item, in order, while up to
+        max_in_flight calls run ahead of the consumer in a thread pool.
+        """
+        max_in_flight = max_in_flight or self.max_in_flight
+        if max_in_flight <= 1:
+            for item in itr:
+                yield func(item)
+            return
+
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(max_in_flight) as pool:
+            try:
+                for item in itr:
+                    pending.append(pool.submit(func, item))
+                    if len(pending) >= max_in_flight:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for fut in pending:
+                    fut.cancel()
+
+    def _prefetch(self, itr, maxsize):
+        """Drain itr from a background thread into a queue bounded at
+        maxsize items, so the next page is requested while the consumer
+        is still working through the current one.
+        """
+        buf = queue.Queue(maxsize)
+        stop = threading.Event()
+        done = object()
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    buf.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def _fill():
+            try:
+                for item in itr:
+                    if not _put((item, None)):
+                        return
+                _put((done, None))
+            except Exception as e:
+                _put((done, e))
+
+        threading.Thread(target=_fill, daemon=True).start()
+        try:
+            while True:
+                item, err = buf.get()
+                if item is done:
+                    if err is not None:
+                        raise err
+                    return
+                yield item
+        finally:
+            stop.set()
+
     def _convert_when(self, when):
         result = {}
         start, _, end = when.partition(":")
@@ -80,30 +175,165 @@ class StripeClient:
             )
         return result
 
+    @functools.cached_property
+    def account_key(self):
+        key = self.api_key or stripe.api_key or ""
+        return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+    def _watermark_key(self, kind):
+        return f"{self.account_key}:{kind}"
+
+    def _created_filter(self, when, kind, incremental):
+        """Return the created filter for a listing, and the watermark
+        it resumes from when listing incrementally.
+        """
+        mark = None
+        if incremental:
+            if self.watermarks is None:
+                raise ValueError("incremental listing requires watermarks")
+            mark = self.watermarks.get(self._watermark_key(kind))
+        if mark:
+            # everything since the last run, boundary second included
+            return {"gte": mark["created"]}, mark
+        return self._convert_when(when), mark
+
+    def _incremental_iter(self, kind, itr, mark):
+        """Skip objects already seen at the watermark's second, and
+        advance the watermark once itr is exhausted.
+        """
+        boundary = mark["created"] if mark else None
+        seen = set(mark["ids"]) if mark else set()
+        newest, newest_ids, last_id = boundary, set(seen), None
+        if mark:
+            last_id = mark.get("last_id")
+
+        for obj in itr:
+            created = self._to_timestamp(obj["created"])
+            if created == boundary and obj["id"] in seen:
+                continue
+            if newest is None or created > newest:
+                newest, newest_ids, last_id = created, set(), obj["id"]
+            if created == newest:
+                newest_ids.add(obj["id"])
+            yield obj
+
+        if newest is not None:
+            LOG.info(f"{kind} watermark at {self._from_timestamp(newest)}")
+            self.watermarks.set(self._watermark_key(kind), {
+                "created": newest,
+                "ids": sorted(newest_ids),
+                "last_id": last_id,
+            })
+
+    def _split_created(self, created, shard_by):
+        """Split a created filter into consecutive windows of one
+        shard_by frame (day, week, month, quarter, year), newest first.
+        """
+        if "gte" not in created:
+            return [created]
+        start = created["gte"]
+        end = created.get("lte", self._to_timestamp(arrow.utcnow()))
+        windows = [
+            {
+                "gte": max(start, self._to_timestamp(lo)),
+                "lte": min(end, self._to_timestamp(hi)),
+            }
+            for lo, hi in arrow.Arrow.span_range(
+                shard_by, arrow.get(start), arrow.get(end),
+            )
+        ]
+        return list(reversed(windows))
+
+    def _list(self, resource, created, shard_by=None, **params):
+        """Iterate converted objects of a stripe list resource.
+
+        With shard_by, the created range is split into windows listed
+        concurrently by list_workers threads.  Stripe lists newest first,
+        so chaining the windows newest first keeps the serial order.
+        """
+        params.setdefault("limit", self.page_size)
+
+        def _window_iter(window):
+            result = resource.list(created=window, **params)
+            itr = result.auto_paging_iter()
+            if self.prefetch_pages:
+                maxsize = self.prefetch_pages * params["limit"]
+                itr = self._prefetch(itr, maxsize)
+            return self._from_iter(itr)
+
+        if not shard_by:
+            return _window_iter(created)
+
+        windows = self._split_created(created, shard_by)
+        LOG.info(f"listing {len(windows)} {shard_by} windows")
+        itr = self._run_ahead(
+            lambda w: list(_window_iter(w)), windows, self.list_workers,
+        )
+        return itertools.chain.from_iterable(itr)
+
     @functools.cached_property
     def client(self):
         return stripe.StripeClient(self.api_key)
 
-    def customer_iter(self, when=dflt_when):
-        result = stripe.Customer.list(
-            created=self._convert_when(when)
-        )
-        for obj in self._from_iter(result.auto_paging_iter()):
+    def customer_iter(self, when=dflt_when, incremental=False, shard_by=None):
+        created, mark = self._created_filter(when, "customer", incremental)
+        itr = self._list(stripe.Customer, created, shard_by)
+        if incremental:
+            itr = self._incremental_iter("customer", itr, mark)
+        for obj in itr:
             yield obj
 
-    def balance_transaction_iter(self, when=dflt_when, add_address=True):
-        result = stripe.BalanceTransaction.list(
-            created=self._convert_when(when)
+    def _add_billing_details(self, obj):
+        source = obj.get("source")
+        if isinstance(source, dict):
+            # expanded inline, collapse back to the id
+            charge = source
+            source = obj["source"] = source.get("id")
+        elif source and source.startswith("ch_"):
+            charge = self.get_charge(source)
+        else:
+            return obj
+        if source and source.startswith("ch_"):
+            obj["billing_details"] = charge["billing_details"]
+        return obj
+
+    def balance_transaction_iter(
+        self, when=dflt_when, add_address=True, incremental=False,
+        shard_by=None,
+    ):
+        created, mark = self._created_filter(
+            when, "balance_transaction", incremental,
+        )
+        params = {}
+        if add_address and self.expand_source:
+            params["expand"] = ["data.source"]
+        itr = self._list(
+            stripe.BalanceTransaction, created, shard_by, **params,
         )
-        for obj in self._from_iter(result.auto_paging_iter()):
-            if add_address:
-                if obj["source"].startswith("ch_"):
-                    charge = self.get_charge(obj["source"])
-                    obj["billing_details"] = charge["billing_details"]
+        if add_address:
+            # nothing to wait on when the charges come expanded
+            n = 1 if self.expand_source else self.max_in_flight
+            itr = self._run_ahead(self._add_billing_details, itr, n)
+        if incremental:
+            itr = self._incremental_iter("balance_transaction", itr, mark)
+        for obj in itr:
             yield obj
 
-    def get_charge(self, charge_id):
+    def _retrieve_charge(self, charge_id):
+        if self.charge_cache is not None:
+            charge = self.charge_cache.get(charge_id)
+            if charge is not None:
+                return charge
+
         result = stripe.Charge.retrieve(charge_id)
-        return self._from_stripe_item(result)
+        charge = self._from_stripe_item(result)
+
+        # billing details are stable once a charge settles
+        if self.charge_cache is not None and charge.get("status") != "pending":
+            self.charge_cache.set(charge_id, charge)
+        return charge
+
+    def get_charge(self, charge_id):
+        return self._charges.do(charge_id, self._retrieve_charge, charge_id)
 
 # vi: ts=4 expandtab
@@ -48,6 +48,11 @@ setup(
     packages=packages,
     include_package_data=True,
     install_requires=requires,
+    extras_require={
+        'async': ['httpx'],
+        'fast': ['orjson', 'msgpack'],
+        'columnar': ['pyarrow'],
+    },
     entry_points={
         'console_scripts': [
             'monkepod=monkeypod.cli:monkeypod',